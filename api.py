@@ -0,0 +1,91 @@
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import tornado.ioloop
+import tornado.web
+from export import EXPORTS, export_query
+from charts import DEFAULT_WINDOW_SIZE
+from warehouse import POOL_SIZE, PoolTimeout, ResultCache, fetch_cached, pool, query_cache, warehouse_version
+
+PORT = 8000
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+# DuckDB blocks, so every query runs on one of these threads while the event loop keeps accepting
+# requests, one thread per pooled cursor
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='gridwatch-api')
+# serialising is most of the cost of a cached query, json especially, so the response bodies are
+# cached too, keyed like the results with the format and bounded by their bytes
+payload_cache = ResultCache(getsizeof=len)
+
+def arrow_payload(table):
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def json_payload(table):
+    return json.dumps({'columns': table.column_names, 'rows': table.num_rows, 'data': table.to_pylist()},
+                      default=str).encode()
+
+def run_query(name, window_size, start, end, resolution, arrow):
+    # the same pool and result cache as the dashboard, keyed on the warehouse version so a swapped in
+    # build is served from the next request on
+    query = export_query(name, start, end, window_size, resolution)
+    version = warehouse_version()
+    def serialise():
+        table = fetch_cached(query, version)
+        return arrow_payload(table) if arrow else json_payload(table)
+    return payload_cache.get((query, version, arrow), serialise)
+
+class QueryHandler(tornado.web.RequestHandler):
+    # GET /query/<name>?window_size=50&start=2020-01-01&end=2020-12-31&resolution=daily&format=json|arrow,
+    # Arrow IPC is also picked by an Accept header of application/vnd.apache.arrow.stream
+
+    async def get(self, name):
+        if name not in EXPORTS:
+            raise tornado.web.HTTPError(404, reason=f'unknown query {name}')
+        arrow = self.get_query_argument('format', None) == 'arrow' or \
+            ARROW_STREAM in self.request.headers.get('Accept', '')
+        try:
+            window_size = int(self.get_query_argument('window_size', DEFAULT_WINDOW_SIZE))
+            args = (name, window_size, self.get_query_argument('start', None), self.get_query_argument('end', None),
+                    self.get_query_argument('resolution', 'daily'), arrow)
+            body = await tornado.ioloop.IOLoop.current().run_in_executor(executor, run_query, *args)
+        except ValueError as error:
+            # a bad window size, resolution or date, caught before any sql reaches DuckDB
+            raise tornado.web.HTTPError(400, reason=str(error))
+        except PoolTimeout as error:
+            raise tornado.web.HTTPError(503, reason=str(error))
+        self.set_header('Content-Type', ARROW_STREAM if arrow else 'application/json')
+        self.write(body)
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header('Content-Type', 'application/json')
+        self.finish({'error': self._reason, 'status': status_code})
+
+class QueriesHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({'queries': list(EXPORTS)})
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({'pool': pool.stats(), 'cache': query_cache.stats(), 'payloads': payload_cache.stats()})
+
+def make_app():
+    return tornado.web.Application([
+        (r'/queries', QueriesHandler),
+        (r'/query/([a-z_]+)', QueryHandler),
+        (r'/stats', StatsHandler),
+    ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve the dashboard queries as JSON or Arrow over HTTP.')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--address', default='127.0.0.1')
+    args = parser.parse_args()
+
+    make_app().listen(args.port, args.address)
+    print(f'serving {", ".join(EXPORTS)} on http://{args.address}:{args.port}/query/<name>')
+    tornado.ioloop.IOLoop.current().start()
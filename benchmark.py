@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import duckdb as duck
+from instrumentation import PeakMemory
+
+# one 1x scale is BASE_YEARS of 5 minute readings, 100x is then about the size of the real Gridwatch history
+BASE_YEARS = 0.1
+SCALES = [1, 10, 100]
+DUPLICATE_RATE = 0.01
+REPEAT = 5
+WINDOW_SIZE = 50
+HOURLY_DAYS = 30
+START = '2012-01-01'
+
+RAW_COLUMNS = ['demand', 'frequency', 'coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil',
+               'solar', 'ocgt', 'french_ict', 'dutch_ict', 'irish_ict', 'ew_ict', 'nemo', 'other', 'north_south',
+               'scotland_england', 'ifa2', 'intelec_ict', 'nsl', 'vkl_ict']
+
+# rough shape of every reading, (mean, daily swing, noise), demand peaks in the evening, generation
+# never goes below zero while the interconnectors and links flow both ways
+GENERATION = ['demand', 'coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt']
+READINGS = {
+    'demand': (28000, 8000, 1500),
+    'frequency': (50, 0, 0.05),
+    'coal': (6000, 2000, 800),
+    'nuclear': (7000, 0, 300),
+    'ccgt': (11000, 4000, 1200),
+    'wind': (4000, 500, 2500),
+    'solar': (800, 1200, 300),
+    'ocgt': (20, 20, 10),
+}
+
+QUERIES = ['demand_over_time_query', 'energy_contribution_query', 'demand_during_sleep_query',
+           'ict_visualization_query', 'demand_v_production_query']
+
+def reading_sql(column):
+    mean, swing, noise = READINGS.get(column, (300, 200, 400))
+    daily = f"{swing} * SIN(2 * PI() * (EXTRACT(HOUR FROM ts) - 12) / 24)"
+    value = f"{mean} + {daily} + {noise} * (RANDOM() * 2 - 1)"
+    if column in GENERATION:
+        return f'GREATEST(ROUND({value}), 0) AS " {column}"'
+    return f'ROUND({value}, 3) AS " {column}"'
+
+def generate_gridwatch(path, years=BASE_YEARS, duplicate_rate=DUPLICATE_RATE, start=START, seed=0.42):
+    # Gridwatch shaped raw export, padded column names, a padded text timestamp every 5 minutes and
+    # duplicate_rate of the rows repeated, written by DuckDB so 100x scale needs no pandas
+    con = duck.connect()
+    try:
+        con.execute('SET enable_progress_bar = false')
+        con.execute('SELECT SETSEED(?)', [seed])
+        minutes = int(years * 365.25 * 24 * 60)
+        con.execute(f"""CREATE TEMP TABLE readings AS
+                        SELECT
+                            ROW_NUMBER() OVER (ORDER BY ts) AS " id",
+                            STRFTIME(ts, ' %Y-%m-%d %H:%M:%S') AS " timestamp",
+                            {', '.join(reading_sql(column) for column in RAW_COLUMNS)}
+                        FROM range(TIMESTAMP '{start}', TIMESTAMP '{start}' + INTERVAL {minutes} MINUTE,
+                                   INTERVAL 5 MINUTE) AS t(ts)""")
+        con.execute(f"""COPY (
+                            SELECT * FROM readings
+                            UNION ALL
+                            SELECT * FROM readings WHERE RANDOM() < {float(duplicate_rate)}
+                            ORDER BY " id")
+                        TO '{path}' (FORMAT parquet)""")
+        return con.execute(f"SELECT COUNT(*) FROM read_parquet('{path}')").fetchone()[0]
+    finally:
+        con.close()
+
+def measure(name, run, rows_in=None):
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        rows = run()
+        wall = time.perf_counter() - start
+    rows = rows if isinstance(rows, int) else None
+    throughput = rows_in if rows_in is not None else rows
+    return {
+        'name': name,
+        'wall_s': round(wall, 6),
+        'peak_rss_mb': memory.peak_mb,
+        'rows': rows,
+        'rows_per_sec': round(throughput / wall, 1) if throughput and wall else None,
+    }
+
+def benchmark_build(raw_rows):
+    import create_schema
+
+    results = []
+    con = duck.connect('data_warehouse.duckdb')
+    try:
+        results.append(measure('data_cleaning', lambda: create_schema.data_cleaning(con, create_schema.raw_data)))
+        con.begin()
+        for name, stage in create_schema.BUILD_STAGES:
+            results.append(measure(name, lambda stage=stage: stage(con, None), raw_rows))
+        con.commit()
+    finally:
+        con.close()
+    return results
+
+def benchmark_incremental():
+    # rebuild from everything but the last week, then time the incremental run that adds it
+    import create_schema
+
+    full = create_schema.raw_data
+    con = duck.connect()
+    con.execute(f"""COPY (SELECT * FROM read_parquet('{full}')
+                          WHERE CAST(" timestamp" AS TIMESTAMP) <
+                                (SELECT MAX(CAST(" timestamp" AS TIMESTAMP)) FROM read_parquet('{full}')) - INTERVAL 7 DAY)
+                    TO 'previous.parquet' (FORMAT parquet)""")
+    con.close()
+    os.remove('data_warehouse.duckdb')
+    create_schema.raw_data = 'previous.parquet'
+    create_schema.get_fact_gridwatch()
+    create_schema.raw_data = full
+    return [measure('incremental_build', lambda: create_schema.get_fact_gridwatch(incremental=True))]
+
+def benchmark_queries(repeat=REPEAT, window_size=WINDOW_SIZE):
+    # every dashboard query over the full history at daily resolution and over the last
+    # HOURLY_DAYS days at hourly resolution, the first run is a warm-up and not timed
+    import queries
+
+    con = duck.connect('data_warehouse.duckdb', read_only=True)
+    try:
+        last = con.execute("SELECT MAX(date) FROM data_warehouse.daily_rollup_table").fetchone()[0]
+        first = last - timedelta(days=HOURLY_DAYS - 1)
+        cases = []
+        for name in QUERIES:
+            query = getattr(queries, name)
+            if name == 'demand_during_sleep_query':
+                cases.append((f'{name}[full]', query()))
+                cases.append((f'{name}[{HOURLY_DAYS}d]', query(first, last)))
+            else:
+                cases.append((f'{name}[daily]', query(window_size)))
+                cases.append((f'{name}[hourly,{HOURLY_DAYS}d]', query(window_size, first, last, 'hourly')))
+
+        results = []
+        for name, sql in cases:
+            con.execute(sql).fetch_arrow_table()
+            runs = [measure(name, lambda: con.execute(sql).fetch_arrow_table().num_rows) for _ in range(repeat)]
+            result = min(runs, key=lambda run: run['wall_s'])
+            result['median_wall_s'] = round(statistics.median(run['wall_s'] for run in runs), 6)
+            result['peak_rss_mb'] = max((run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None), default=None)
+            results.append(result)
+        return results
+    finally:
+        con.close()
+
+def run_scale(scale, years=BASE_YEARS, duplicate_rate=DUPLICATE_RATE, repeat=REPEAT, keep=None, compact=False):
+    # runs in its own process so the peak memory of one scale does not carry over into the next
+    work_dir = keep or tempfile.mkdtemp(prefix=f'gridwatch-bench-{scale}x-')
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import create_schema
+
+    generate_start = time.perf_counter()
+    raw_rows = generate_gridwatch('gridwatch.parquet', years * scale, duplicate_rate)
+    generate_wall = time.perf_counter() - generate_start
+    create_schema.raw_data = 'gridwatch.parquet'
+    create_schema.compact_storage = compact
+    if os.path.exists('data_warehouse.duckdb'):
+        os.remove('data_warehouse.duckdb')
+
+    build = benchmark_build(raw_rows)
+    warehouse_bytes = os.path.getsize('data_warehouse.duckdb')
+    query_results = benchmark_queries(repeat)
+    incremental = benchmark_incremental()
+    if keep is None:
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+    return {
+        'scale': scale,
+        'years': years * scale,
+        'raw_rows': raw_rows,
+        'generate_s': round(generate_wall, 3),
+        'build': build + incremental,
+        'build_total_s': round(sum(stage['wall_s'] for stage in build), 6),
+        'warehouse_mb': round(warehouse_bytes / 2 ** 20, 1),
+        'queries': query_results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmark(scales=SCALES, years=BASE_YEARS, duplicate_rate=DUPLICATE_RATE, repeat=REPEAT, keep=None,
+                  compact=False):
+    results = []
+    for scale in scales:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            work_dir = os.path.join(keep, f'{scale}x') if keep else None
+            results.append(executor.submit(run_scale, scale, years, duplicate_rate, repeat, work_dir, compact).result())
+    return {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'duckdb': duck.__version__,
+        'cpu_count': os.cpu_count(),
+        'duplicate_rate': duplicate_rate,
+        'compact': compact,
+        'scales': results,
+    }
+
+def compare(baseline, current):
+    # wall time of every stage and query relative to the baseline run, above 1 is slower
+    def walls(report):
+        return {(scale['scale'], entry['name']): entry['wall_s']
+                for scale in report['scales'] for entry in scale['build'] + scale['queries']}
+    before, after = walls(baseline), walls(current)
+    return [{'scale': scale, 'name': name, 'baseline_s': before[scale, name], 'current_s': after[scale, name],
+             'ratio': round(after[scale, name] / before[scale, name], 3) if before[scale, name] else None}
+            for scale, name in after if (scale, name) in before]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the warehouse build and the dashboard queries on synthetic Gridwatch data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='multiples of the base dataset to run')
+    parser.add_argument('--years', type=float, default=BASE_YEARS, help='years of 5 minute readings at 1x scale')
+    parser.add_argument('--duplicate-rate', type=float, default=DUPLICATE_RATE, help='fraction of raw rows repeated')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs of every query')
+    parser.add_argument('--compact', action='store_true', help='build the compact warehouse layout')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare wall times against')
+    parser.add_argument('--keep', help='directory to keep the generated data and warehouses in')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.scales, args.years, args.duplicate_rate, args.repeat, args.keep, args.compact)
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(json.load(f), report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    else:
+        print(json.dumps(report, indent=2, default=str))
@@ -0,0 +1,118 @@
+import plotly.express as px
+from queries import *
+from downsample import MAX_POINTS, downsample_trace, downsample_traces
+from metrics import ChartTimer
+
+# the figures of the dashboard, every chart takes fetch(query, timer) returning the result columns as
+# NumPy arrays so the app can serve them from the shared cache and the build from its own connection
+
+PERIODS = {'hourly': 'Hour', 'daily': 'Day', 'weekly': 'Week', 'monthly': 'Month'}
+
+# the moving average slider of the app
+WINDOW_SIZES = list(range(10, 101, 10))
+DEFAULT_WINDOW_SIZE = 50
+
+def arrays(table, timer):
+    # the moving averages are already computed by the queries so the charts only need the columns as NumPy arrays
+    data = {name: table[name].to_numpy() for name in table.column_names}
+    timer.size('rows', table.num_rows)
+    timer.size('arrow_bytes', table.nbytes)
+    return data
+
+def connection_fetch(con):
+    def fetch(query, timer=None):
+        timer = timer or ChartTimer(None)
+        with timer.phase('query'):
+            return arrays(con.execute(query).fetch_arrow_table(), timer)
+    return fetch
+
+def plotted(timer, df):
+    timer.size('points', len(next(iter(df.values()))))
+    return df
+
+def demand_over_time(fetch, window_size, start=None, end=None, resolution='daily', timer=None):
+    timer = timer or ChartTimer("Total Electricity Demand Over Time")
+    period = PERIODS[resolution]
+    data = fetch(demand_over_time_query(window_size, start, end, resolution), timer)
+    with timer.phase('transform'):
+        df = plotted(timer, downsample_trace(data, 'date', 'smoothed_demand', MAX_POINTS))
+
+    with timer.phase('figure'):
+        fig = px.line(df, x='date', y='smoothed_demand', 
+                      title=f'Electricity demand vs Time ({window_size}-{period} Moving Average)',
+                      labels={'smoothed_demand': 'Electricity  Demand (GW)', 'date': 'Time'})
+        fig.update_traces(line=dict(width=1.2))
+
+    return "Total Electricity Demand Over Time", fig, f"This chart shows the total electricity demand over time, smoothed using a {window_size}-{period.lower()} moving average. \
+            Throughout the time, we can see overall the electricity demand is growing smaller each year. \
+            We can also observed significant dip during year 2020, probably due to the pandemic COVID-19 that impacted the electricity supply."
+
+def energy_contribution(fetch, window_size, start=None, end=None, resolution='daily', timer=None):
+    timer = timer or ChartTimer("Average Energy Sources Trend")
+    period = PERIODS[resolution]
+    data = fetch(energy_contribution_query(window_size, start, end, resolution), timer)
+    with timer.phase('transform'):
+        df = plotted(timer, downsample_traces(data, 'date', ENERGY_SOURCES, MAX_POINTS))
+
+    with timer.phase('figure'):
+        fig = px.line(  df, x='date', y='value', color='variable', 
+                        title=f'Energy sources comparison ({window_size}-{period} Moving Average)',
+                        labels={'value': 'Energy', 'date': 'Time'})
+    
+    return "Average Energy Sources Trend", fig, f"This chart shows the contribution of various energy sources over time using a {window_size}-{period.lower()} moving average. \
+                                                    There is a clear downtrend of non renewable energy sources such as coal and oil. \
+                                                    While at the same time there is an uptrend of renewable energy sources such as solar, biomass and wind. \
+                                                    Overall majority of renewable energy sources have a consistent increasing growing trend."
+
+def demand_during_sleep(fetch, window_size=None, start=None, end=None, resolution='daily', timer=None):
+    # the hour of day profile has no moving average or resolution, they are taken to match the other charts
+    timer = timer or ChartTimer("Electricity Demand Per Day")
+    df = plotted(timer, fetch(demand_during_sleep_query(start, end), timer))
+    with timer.phase('figure'):
+        fig = px.line(df, x='hour', y='avg_demand')
+    return "Electricity Demand Per Day", fig, "This chart depicts the average electricity demand during sleep hours . \
+        This simple chart illustrate the polar relationship between electricity every day. \
+            It can be clearly seen that the electricity demand starts to spike around 9am which is commonly the start working hours and peaked at around 6pm of the day. \
+                The electricity demand then will drop aligning with them time of people sleeping. \
+                     The demand also have little dip around 12pm-2pm which marks the common time of people having a break from their work. "
+
+def ict_visualization(fetch, window_size, start=None, end=None, resolution='daily', timer=None):
+    timer = timer or ChartTimer("Interconnectors Comparison")
+    period = PERIODS[resolution]
+    data = fetch(ict_visualization_query(window_size, start, end, resolution), timer)
+    with timer.phase('transform'):
+        df = plotted(timer, downsample_traces(data, 'date', INTERCONNECTORS, MAX_POINTS))
+    with timer.phase('figure'):
+        fig = px.line(  df, x='date', y='value', color='variable', 
+                        title=f'Average Interconnector Flows Over Time ({window_size}-{period} Moving Average)',
+                        labels={'value': 'Average Flow', 'date': 'Date'})
+    
+    return "Interconnectors Comparison", fig, "This chart shows the average flows of various interconnectors over time. \
+        This chart illustrate the flows of in and out of interconnectors in the UK. \
+            We can also see north south interconnector contribute the highest average amount of electricity."
+
+def demand_v_production(fetch, window_size, start=None, end=None, resolution='daily', timer=None):
+    timer = timer or ChartTimer("Demand vs Production")
+    period = PERIODS[resolution]
+    data = fetch(demand_v_production_query(window_size, start, end, resolution), timer)
+    with timer.phase('transform'):
+        df = plotted(timer, downsample_traces(data, 'date', ['total_demand', 'total_production'], MAX_POINTS))
+
+    with timer.phase('figure'):
+        fig = px.line(  df, x='date', y='value', color='variable',
+                        title=f'Yearly Electricity Demand vs Production ({window_size}-{period} Moving Average)',
+                        labels={'value': 'Electricity (GW)', 'date': 'Date'},
+                        color_discrete_sequence=['blue', 'orange'])
+    return "Demand vs Production", fig, "This chart compares the yearly electricity demand against the total production. \
+        Overall bigger picture is for quite some time, total electricity produce is larger than total demand needed which is always good in case of supplying backup electricity due to blackout. \
+            But it started around 2016 which coincidently is when north south interconnector coming into play. \
+                This probably helped UK grid stabilizes the electricty to overcome the demand spikes of it."
+
+# in page order
+CHARTS = {
+    "Total Electricity Demand Over Time": demand_over_time,
+    "Average Energy Sources Trend": energy_contribution,
+    "Demand vs Production": demand_v_production,
+    "Electricity Demand Per Day": demand_during_sleep,
+    "Interconnectors Comparison": ict_visualization,
+}
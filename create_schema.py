@@ -1,19 +1,45 @@
-import pandas as pd
+import argparse
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import duckdb as duck
+import pyarrow as pa
+from instrumentation import RunLog
+from charts import CHARTS, WINDOW_SIZES, connection_fetch
 
 raw_data = 'gridwatch.parquet'
-con = duck.connect('data_warehouse.duckdb')
+warehouse = 'data_warehouse.duckdb'
 
-def data_cleaning(raw_data):
-    df = pd.read_parquet(raw_data)
-    df.drop_duplicates(inplace=True)
-    df.columns = df.columns.str.strip()
-    return df
+# with aggregate_workers set the hourly aggregation runs in chunks of raw data on that many workers,
+# each its own in-memory DuckDB limited to aggregate_memory_limit, None aggregates in one statement
+aggregate_workers = None
+aggregate_memory_limit = '1GB'
+# every chunk re-reads its rows from the raw data, a single parquet file is scanned whole by every chunk
+# while the partitioned data lake only opens the chunk's own months
+aggregate_chunk_months = 12
 
-def create_schema_aggregate_main_table(con, df):
+# with compact_storage a full build stores the measures as REAL and the keys as INTEGER, the ids that
+# only repeat timestamp_id and the calendar parts of the daily rollup become generated columns, an
+# incremental build keeps the layout of the warehouse it builds on
+compact_storage = False
 
-    aggregate_main_table_df = con.execute("""
-        WITH data_aggregate AS (
+# when the build renders the figures of figure_cache_table, 'full' only on a full build, 'always' also on
+# an incremental refresh and 'never', a figure of an older version is never served so the app draws the
+# charts live until the next build that renders them
+precompute_figures = 'full'
+FIGURE_MODES = ['full', 'always', 'never']
+
+# narrowest type of every calendar part, used by the compact layout
+CALENDAR_TYPES = {'year': 'SMALLINT', 'month': 'UTINYINT', 'day': 'UTINYINT', 'hour': 'UTINYINT'}
+
+# every hour is keyed by the hours since the epoch, the same key whichever build or chunk produced it
+HOUR_KEY = "DATE_DIFF('hour', TIMESTAMP '1970-01-01', time)"
+
+AGGREGATE_HOURLY = f"""
+            SELECT
+                {HOUR_KEY} AS timestamp_id,
+                *
+            FROM (
             SELECT
                 DATE_TRUNC('hour', CAST(timestamp AS TIMESTAMP)) AS time,
                 SUM(demand) AS demand,
@@ -40,44 +66,257 @@ def create_schema_aggregate_main_table(con, df):
                 SUM(intelec_ict) AS intelec_ict,
                 SUM(nsl) AS nsl,
                 SUM(vkl_ict) AS vkl_ict
-            FROM df
-            GROUP BY time
-            ORDER BY time
-            )
-            SELECT 
-                ROW_NUMBER() OVER () AS timestamp_id,
-                *
-            FROM data_aggregate                   
-            """).fetchdf()
-    con.execute('''CREATE OR REPLACE TABLE data_warehouse.aggregate_main_table (
-                        timestamp_id BIGINT PRIMARY KEY,
-                        time TIMESTAMP,
-                        demand DOUBLE,
-                        avg_frequency DOUBLE,
-                        coal DOUBLE,
-                        nuclear DOUBLE,
-                        ccgt DOUBLE,
-                        wind DOUBLE,
-                        pumped DOUBLE,
-                        hydro DOUBLE,
-                        biomass DOUBLE,
-                        oil DOUBLE,
-                        solar DOUBLE,
-                        ocgt DOUBLE,
-                        french_ict DOUBLE,
-                        dutch_ict DOUBLE,
-                        irish_ict DOUBLE,
-                        ew_ict DOUBLE,
-                        nemo DOUBLE,
-                        other DOUBLE,
-                        north_south DOUBLE,
-                        scotland_england DOUBLE,
-                        ifa2 DOUBLE,
-                        intelec_ict DOUBLE,
-                        nsl DOUBLE,
-                        vkl_ict DOUBLE);''')
-    con.execute('''INSERT INTO data_warehouse.aggregate_main_table 
-                        SELECT * FROM aggregate_main_table_df
+            FROM raw_clean
+            GROUP BY time)"""
+
+def connect_warehouse(database=warehouse, read_only=False):
+    # the file attached as data_warehouse to an in-memory DuckDB, so the catalog keeps its name whatever
+    # the file is called and every connection is its own instance of the file it found, not one cached
+    # per path that would outlive a swap
+    con = duck.connect()
+    con.execute(f"ATTACH '{database}' AS data_warehouse{' (READ_ONLY)' if read_only else ''}")
+    con.execute('USE data_warehouse')
+    return con
+
+def staging_path(database=warehouse):
+    root, extension = os.path.splitext(database)
+    return f'{root}.building-{os.getpid()}{extension}'
+
+def raw_source(raw_data):
+    # a directory is the year/month partitioned data lake written by ingest.py
+    path = raw_data.replace("'", "''")
+    if os.path.isdir(raw_data):
+        return f"read_parquet('{path}/**/*.parquet', hive_partitioning = true)", True
+    return f"read_parquet('{path}')", False
+
+def data_cleaning(con, raw_data, since=None, until=None):
+    # everything stays inside DuckDB, raw_table strips the column names and raw_clean drops
+    # the duplicates, both are views so the parquet files are only read by the statements using them
+    source, partitioned = raw_source(raw_data)
+    columns = [column for column in con.sql(f"SELECT * FROM {source} LIMIT 0").columns
+               if not (partitioned and column in ('year', 'month'))]
+    select = ',\n'.join(f'"{column}" AS "{column.strip()}"' for column in columns)
+    partition_filters = []
+    time_filters = []
+    if since is not None:
+        # incremental build, only keep the rows from the last (possibly partial) hour onwards
+        time_filters.append(f"CAST(timestamp AS TIMESTAMP) >= TIMESTAMP '{since.isoformat(sep=' ')}'")
+        if partitioned:
+            # lets DuckDB skip the files of older partitions without opening them
+            partition_filters.append(f"(year > {since.year} OR (year = {since.year} AND month >= {since.month}))")
+    if until is not None:
+        # one chunk of a chunked aggregation, only the rows before until
+        time_filters.append(f"CAST(timestamp AS TIMESTAMP) < TIMESTAMP '{until.isoformat(sep=' ')}'")
+        if partitioned:
+            partition_filters.append(f"(year < {until.year} OR (year = {until.year} AND month <= {until.month}))")
+    partition_filter = f"WHERE {' AND '.join(partition_filters)}" if partition_filters else ''
+    time_filter = f"WHERE {' AND '.join(time_filters)}" if time_filters else ''
+
+    con.execute(f"""CREATE OR REPLACE TEMP VIEW raw_table AS
+                    SELECT * FROM (SELECT {select} FROM {source} {partition_filter})
+                    {time_filter}""")
+    # a duplicate is a reading with the same timestamp and the same values, the values are hashed into
+    # one UBIGINT so DuckDB groups on two narrow keys instead of every column, the id is left out as
+    # it only numbers the rows of the export
+    readings = [column.strip() for column in columns if column.strip() not in ('id', 'timestamp')]
+    con.execute(f"""CREATE OR REPLACE TEMP VIEW raw_hashed AS
+                    SELECT
+                        *,
+                        CAST(timestamp AS TIMESTAMP) AS reading_time,
+                        HASH({', '.join(f'"{column}"' for column in readings)}) AS row_hash
+                    FROM raw_table""")
+    con.execute(f"""CREATE OR REPLACE TEMP VIEW raw_clean AS
+                    SELECT DISTINCT ON (reading_time, row_hash) {', '.join(f'"{column.strip()}"' for column in columns)}
+                    FROM raw_hashed""")
+    return 'raw_clean'
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+def raw_chunks(con, months):
+    # the raw data as (start, end) bounds of months calendar months each, one chunk of the aggregation
+    # each, an hour never spans two months so every chunk aggregates to complete hours
+    present = [month for month, in con.execute("""
+            SELECT DISTINCT CAST(DATE_TRUNC('month', CAST(timestamp AS TIMESTAMP)) AS TIMESTAMP) AS month
+            FROM raw_table
+            ORDER BY month""").fetchall()]
+    starts = sorted({add_months(month, -((month.year * 12 + month.month - 1) % months)) for month in present})
+    return [(start, add_months(start, months)) for start in starts]
+
+def aggregate_chunk(raw_data, since, start, end, memory_limit, threads):
+    # runs in a worker thread on its own in-memory DuckDB, so neither the memory limit nor the
+    # threads of one chunk are shared with the build connection or the other chunks
+    con = duck.connect(config={'memory_limit': memory_limit, 'threads': threads})
+    try:
+        data_cleaning(con, raw_data, start if since is None else max(start, since), end)
+        return con.execute(AGGREGATE_HOURLY).fetch_arrow_table()
+    finally:
+        con.close()
+
+def aggregate_chunked(con, since, workers, memory_limit):
+    chunks = raw_chunks(con, aggregate_chunk_months)
+    if not chunks:
+        return None
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tables = executor.map(lambda chunk: aggregate_chunk(raw_data, since, *chunk, memory_limit, threads), chunks)
+        return pa.concat_tables(list(tables))
+
+def has_table(con, name):
+    return con.execute("""
+            SELECT COUNT(*)
+            FROM information_schema.tables
+            WHERE table_catalog = 'data_warehouse' AND table_name = ?
+    """, [name]).fetchone()[0] > 0
+
+def get_high_water_mark(con):
+    # last raw timestamp ingested by a previous build, None when there is nothing to build on
+    if not has_table(con, 'warehouse_state'):
+        return None
+    return con.execute("SELECT MAX(last_timestamp) FROM data_warehouse.warehouse_state").fetchone()[0]
+
+def get_warehouse_version(con):
+    # bumped by every build, readers use it to invalidate the results they cached
+    versioned = con.execute("""
+            SELECT COUNT(*)
+            FROM duckdb_columns()
+            WHERE database_name = 'data_warehouse' AND table_name = 'warehouse_state' AND column_name = 'version'
+    """).fetchone()[0]
+    if not versioned:
+        return 0
+    return con.execute("SELECT COALESCE(MAX(version), 0) FROM data_warehouse.warehouse_state").fetchone()[0]
+
+def create_schema_warehouse_state(con, since=None):
+
+    version = get_warehouse_version(con) + 1
+    if since is None:
+        con.execute('''CREATE OR REPLACE TABLE data_warehouse.warehouse_state (
+                            last_timestamp TIMESTAMP,
+                            updated_at TIMESTAMP,
+                            version BIGINT);''')
+    else:
+        con.execute("ALTER TABLE data_warehouse.warehouse_state ADD COLUMN IF NOT EXISTS version BIGINT")
+
+    last_timestamp = con.execute('''SELECT GREATEST(
+                                        (SELECT MAX(CAST(timestamp AS TIMESTAMP)) FROM raw_table),
+                                        (SELECT MAX(last_timestamp) FROM data_warehouse.warehouse_state))
+                                ''').fetchone()[0]
+    con.execute('DELETE FROM data_warehouse.warehouse_state')
+    return con.execute('INSERT INTO data_warehouse.warehouse_state VALUES (?, CURRENT_TIMESTAMP, ?)',
+                       [last_timestamp, version]).fetchone()[0]
+
+def create_schema_ingested_rows_table(con, since=None):
+
+    # the seen-set, (timestamp, row_hash) of every distinct raw row ingested so far, 16 bytes a row written
+    # in time order, so an incremental build only checks its new rows against the hours it rebuilds
+    if since is None:
+        con.execute('''CREATE OR REPLACE TABLE data_warehouse.ingested_rows_table (
+                            timestamp TIMESTAMP,
+                            row_hash UBIGINT);''')
+    con.execute('''CREATE TABLE IF NOT EXISTS data_warehouse.ingest_report_table (
+                        ingested_at TIMESTAMP,
+                        since TIMESTAMP,
+                        raw_rows BIGINT,
+                        already_ingested BIGINT,
+                        new_rows BIGINT,
+                        duplicates_dropped BIGINT,
+                        conflicting_rows BIGINT);''')
+
+    con.execute('''CREATE OR REPLACE TEMP TABLE raw_batch AS
+                        SELECT reading_time, row_hash, COUNT(*) AS copies
+                        FROM raw_hashed
+                        GROUP BY ALL''')
+    con.execute('''CREATE OR REPLACE TEMP TABLE raw_new AS
+                        SELECT batch.reading_time, batch.row_hash
+                        FROM raw_batch AS batch
+                        ANTI JOIN (SELECT *
+                                   FROM data_warehouse.ingested_rows_table
+                                   WHERE $since IS NULL OR timestamp >= $since) AS seen
+                            ON seen.timestamp = batch.reading_time AND seen.row_hash = batch.row_hash''',
+                {'since': since})
+    # conflicting rows are the new rows at a timestamp with readings of different values, in this build or
+    # an earlier one, the aggregation keeps every one of them as before but they are counted here
+    con.execute('''INSERT INTO data_warehouse.ingest_report_table
+                        SELECT
+                            CURRENT_TIMESTAMP,
+                            $since,
+                            (SELECT COALESCE(SUM(copies), 0) FROM raw_batch),
+                            (SELECT COUNT(*) FROM raw_batch) - (SELECT COUNT(*) FROM raw_new),
+                            (SELECT COUNT(*) FROM raw_new),
+                            (SELECT COALESCE(SUM(copies - 1), 0) FROM raw_batch),
+                            (SELECT COUNT(*)
+                             FROM raw_new
+                             WHERE reading_time IN (
+                                SELECT reading_time
+                                FROM (SELECT reading_time, row_hash FROM raw_batch
+                                      UNION
+                                      SELECT timestamp, row_hash
+                                      FROM data_warehouse.ingested_rows_table
+                                      WHERE timestamp IN (SELECT reading_time FROM raw_new))
+                                GROUP BY reading_time
+                                HAVING COUNT(*) > 1))''',
+                {'since': since})
+    try:
+        return con.execute('''INSERT INTO data_warehouse.ingested_rows_table
+                                SELECT reading_time, row_hash FROM raw_new ORDER BY reading_time''').fetchone()[0]
+    finally:
+        con.execute('DROP TABLE raw_batch')
+        con.execute('DROP TABLE raw_new')
+
+def get_ingest_report(con):
+    # duplicate and conflicting rows seen by the latest build, None before the first build
+    result = con.execute('''SELECT * FROM data_warehouse.ingest_report_table
+                            ORDER BY ingested_at DESC LIMIT 1''')
+    columns = [column for column, *_ in result.description]
+    row = result.fetchone()
+    return dict(zip(columns, row)) if row is not None else None
+
+def create_schema_aggregate_main_table(con, since=None):
+
+    if since is None:
+        key, measure = column_types()
+        con.execute(f'''CREATE OR REPLACE TABLE data_warehouse.aggregate_main_table (
+                            timestamp_id {key} PRIMARY KEY,
+                            time TIMESTAMP,
+                            demand {measure},
+                            avg_frequency {measure},
+                            coal {measure},
+                            nuclear {measure},
+                            ccgt {measure},
+                            wind {measure},
+                            pumped {measure},
+                            hydro {measure},
+                            biomass {measure},
+                            oil {measure},
+                            solar {measure},
+                            ocgt {measure},
+                            french_ict {measure},
+                            dutch_ict {measure},
+                            irish_ict {measure},
+                            ew_ict {measure},
+                            nemo {measure},
+                            other {measure},
+                            north_south {measure},
+                            scotland_england {measure},
+                            ifa2 {measure},
+                            intelec_ict {measure},
+                            nsl {measure},
+                            vkl_ict {measure});''')
+
+    source = AGGREGATE_HOURLY
+    if aggregate_workers:
+        chunks = aggregate_chunked(con, since, aggregate_workers, aggregate_memory_limit)
+        if chunks is None:
+            return 0
+        con.register('aggregate_chunks', chunks)
+        source = 'SELECT * FROM aggregate_chunks'
+
+    # rows are written in time order so every table is clustered on time, the min/max DuckDB keeps per
+    # row group then lets a date range query skip the row groups outside the range
+    try:
+        return con.execute(f'''INSERT INTO data_warehouse.aggregate_main_table
+                        SELECT * FROM ({source}) ORDER BY time
                         ON CONFLICT (timestamp_id) DO UPDATE SET
                             time = excluded.time,
                             demand = excluded.demand,
@@ -103,192 +342,438 @@ def create_schema_aggregate_main_table(con, df):
                             ifa2 = excluded.ifa2,
                             intelec_ict = excluded.intelec_ict,
                             nsl = excluded.nsl,
-                            vkl_ict = excluded.vkl_ict''')
-    return aggregate_main_table_df
-
-def create_schema_time_table(con, aggregate_main_table):
-
-    dim_time_table_df = con.execute(""" SELECT
-                                        ROW_NUMBER() OVER () AS time_id,
-                                        timestamp_id,
-                                        time,
-                                        EXTRACT(YEAR FROM time) AS year,
-                                        EXTRACT(MONTH FROM time) AS month,
-                                        EXTRACT(DAY FROM time) AS day,
-                                        EXTRACT(HOUR FROM time) AS hour,
-                                    FROM data_warehouse.aggregate_main_table""").fetchdf()
-    
-    con.execute('''CREATE OR REPLACE TABLE data_warehouse.dim_time_table (
-                    time_id BIGINT PRIMARY KEY,
-                    timestamp_id BIGINT,
-                    time TIMESTAMP,
-                    year BIGINT,
-                    month BIGINT,
-                    day BIGINT,
-                    hour BIGINT
-                    );''')
-
-    con.execute('''INSERT INTO data_warehouse.dim_time_table
-                SELECT * FROM dim_time_table_df
-                ON CONFLICT (time_id) DO UPDATE SET
-                    time = excluded.time,
-                    year = excluded.year,
-                    month = excluded.month,
-                    day = excluded.day,
-                    hour = excluded.hour
-                ''')
-    return dim_time_table_df
-
-def create_schema_energy_table(con, aggregate_main_table):
-
-
-    dim_energy_table_df = con.execute("""
-            SELECT
-                ROW_NUMBER() OVER () AS energy_id,
-                timestamp_id,
-                coal,
-                nuclear,
-                ccgt,
-                wind,
-                pumped,
-                hydro,
-                biomass,
-                oil,
-                solar,
-                ocgt
-            FROM aggregate_main_table
-    """).fetchdf()
-    con.execute('''CREATE OR REPLACE TABLE data_warehouse.dim_energy_table (
-                        energy_id BIGINT PRIMARY KEY,
-                        timestamp_id BIGINT,
-                        coal DOUBLE,
-                        nuclear DOUBLE,
-                        ccgt DOUBLE,
-                        wind DOUBLE,
-                        pumped DOUBLE,
-                        hydro DOUBLE,
-                        biomass DOUBLE,
-                        oil DOUBLE,
-                        solar DOUBLE,
-                        ocgt DOUBLE);
-                    ''')
-    
-    con.execute('''INSERT INTO data_warehouse.dim_energy_table
-                    SELECT * FROM dim_energy_table_df
-                    ON CONFLICT (energy_id) DO UPDATE SET
-                        coal = excluded.coal,
-                        nuclear = excluded.nuclear,
-                        ccgt = excluded.ccgt,
-                        wind = excluded.wind,
-                        pumped = excluded.pumped,
-                        hydro = excluded.hydro,
-                        biomass = excluded.biomass,
-                        oil = excluded.oil,
-                        solar = excluded.solar,
-                        ocgt = excluded.ocgt''')
-    return dim_energy_table_df
-
-def create_schema_interconnectors_table(con, aggregate_main_table):
-
-    dim_ict_table_df = con.execute("""
-            SELECT
-                ROW_NUMBER() OVER () AS ict_id,
-                timestamp_id,
-                french_ict,
-                dutch_ict,
-                irish_ict,
-                ew_ict AS east_west_ict,
-                nemo AS nemo_belgium_ict,
-                other AS other_generator,
-                north_south,
-                scotland_england,
-                ifa2,
-                intelec_ict,
-                nsl AS norway_ict,
-                vkl_ict AS viking_ict
-            FROM aggregate_main_table
-        """).fetchdf()
-    con.execute('''CREATE OR REPLACE TABLE data_warehouse.dim_ict_table (
-                        ict_id BIGINT PRIMARY KEY,
-                        timestamp_id BIGINT,
-                        french_ict DOUBLE,
-                        dutch_ict DOUBLE,
-                        irish_ict DOUBLE,
-                        east_west_ict DOUBLE,
-                        nemo_belgium_ict DOUBLE,
-                        other_generator DOUBLE,
-                        north_south DOUBLE,
-                        scotland_england DOUBLE,
-                        ifa2 DOUBLE,
-                        intelec_ict DOUBLE,
-                        norway_ict DOUBLE,
-                        viking_ict DOUBLE)''')
-    
-    con.execute('''INSERT INTO data_warehouse.dim_ict_table
-                    SELECT * FROM dim_ict_table_df
-                    ON CONFLICT (ict_id) DO UPDATE SET
-                        french_ict = excluded.french_ict,
-                        dutch_ict = excluded.dutch_ict,
-                        irish_ict = excluded.irish_ict,
-                        east_west_ict = excluded.east_west_ict,
-                        nemo_belgium_ict = excluded.nemo_belgium_ict,
-                        other_generator = excluded.other_generator,
-                        north_south = excluded.north_south,
-                        scotland_england = excluded.scotland_england,
-                        ifa2 = excluded.ifa2,   
-                        intelec_ict = excluded.intelec_ict,
-                        norway_ict = excluded.norway_ict,
-                        viking_ict = excluded.viking_ict;''')
-    return dim_ict_table_df
-
-def create_schema_fact_table(con, aggregate_main_table, time_table, energy_sources):
-
-    fact_gridwatch_df = con.execute("""
-            WITH main AS (
-                SELECT
-                    dim_time_table.time_id,
-                    dim_energy_table.energy_id,
-                    dim_ict_table.ict_id,
-                    aggregate_main_table.demand AS total_demand,
-                    aggregate_main_table.avg_frequency AS avg_frequency,
-                FROM dim_time_table
-                JOIN dim_energy_table
-                    ON dim_time_table.timestamp_id = dim_energy_table.timestamp_id
-                JOIN dim_ict_table
-                    ON dim_time_table.timestamp_id = dim_ict_table.timestamp_id
-                JOIN aggregate_main_table
-                    ON dim_time_table.timestamp_id = aggregate_main_table.timestamp_id
-            )
-            SELECT
-                ROW_NUMBER() OVER () AS fact_id,
-                *
-            FROM main
-    """).fetchdf()
-    con.execute('''CREATE OR REPLACE TABLE data_warehouse.fact_table AS
-                SELECT * FROM fact_gridwatch_df''')
-    return fact_gridwatch_df
+                            vkl_ict = excluded.vkl_ict''').fetchone()[0]
+    finally:
+        if aggregate_workers:
+            con.unregister('aggregate_chunks')
+
+def drop_star_schema_table(con, name):
+    # warehouses built before the wide fact table stored the dimensions as tables
+    exists = con.execute("""
+            SELECT COUNT(*)
+            FROM duckdb_tables()
+            WHERE database_name = 'data_warehouse' AND table_name = ?
+    """, [name]).fetchone()[0]
+    if exists:
+        con.execute(f"DROP TABLE data_warehouse.{name}")
+
+def has_wide_fact_table(con):
+    return con.execute("""
+            SELECT COUNT(*)
+            FROM duckdb_columns()
+            WHERE database_name = 'data_warehouse' AND table_name = 'fact_table' AND column_name = 'time'
+    """).fetchone()[0] > 0
+
+def has_time_keys(con):
+    # warehouses from before the time-derived keys numbered the hours with ROW_NUMBER
+    return con.execute(f"""
+            SELECT COUNT(*) = 0
+            FROM data_warehouse.aggregate_main_table
+            WHERE timestamp_id <> {HOUR_KEY}
+    """).fetchone()[0]
+
+def column_types():
+    # (key, measure) column types of a full build, hourly sums of integer MW readings stay exact in a
+    # REAL up to 16.7 million
+    return ('INTEGER', 'REAL') if compact_storage else ('BIGINT', 'DOUBLE')
+
+def calendar(part, column, compact=None):
+    # compact is the layout of the table being rebuilt, the layout of this run when it is created
+    compact = compact_storage if compact is None else compact
+    extract = f"EXTRACT({part.upper()} FROM {column})"
+    return f"CAST({extract} AS {CALENDAR_TYPES[part]})" if compact else extract
+
+def generated_columns(con, table):
+    # the generated columns of a compact table, left out of every insert into it
+    names = [name for name, in con.execute("""
+            SELECT column_name
+            FROM duckdb_columns()
+            WHERE database_name = 'data_warehouse' AND table_name = ? AND column_default IS NOT NULL
+    """, [table]).fetchall()]
+    return f"EXCLUDE ({', '.join(names)})" if names else ''
+
+# every dimension is 1:1 with the hour, so the fact table stores all the measures column-wise keyed by
+# the hour and the dimensions are views over it, kept so queries written against the star schema still
+# work, every id of a row is its timestamp_id so the old join conditions all line up and the calendar
+# parts are derived from time by the dim_time_table view instead of being stored
+
+def create_schema_time_table(con, since=None):
+
+    if since is None:
+        drop_star_schema_table(con, 'dim_time_table')
+        con.execute(f'''CREATE OR REPLACE VIEW data_warehouse.dim_time_table AS
+                        SELECT
+                            time_id,
+                            timestamp_id,
+                            time,
+                            {calendar('year', 'time')} AS year,
+                            {calendar('month', 'time')} AS month,
+                            {calendar('day', 'time')} AS day,
+                            {calendar('hour', 'time')} AS hour
+                        FROM data_warehouse.fact_table''')
+
+def create_schema_energy_table(con, since=None):
+
+    if since is None:
+        drop_star_schema_table(con, 'dim_energy_table')
+        con.execute('''CREATE OR REPLACE VIEW data_warehouse.dim_energy_table AS
+                        SELECT
+                            energy_id,
+                            timestamp_id,
+                            coal,
+                            nuclear,
+                            ccgt,
+                            wind,
+                            pumped,
+                            hydro,
+                            biomass,
+                            oil,
+                            solar,
+                            ocgt
+                        FROM data_warehouse.fact_table''')
+
+def create_schema_interconnectors_table(con, since=None):
+
+    if since is None:
+        drop_star_schema_table(con, 'dim_ict_table')
+        con.execute('''CREATE OR REPLACE VIEW data_warehouse.dim_ict_table AS
+                        SELECT
+                            ict_id,
+                            timestamp_id,
+                            french_ict,
+                            dutch_ict,
+                            irish_ict,
+                            east_west_ict,
+                            nemo_belgium_ict,
+                            other_generator,
+                            north_south,
+                            scotland_england,
+                            ifa2,
+                            intelec_ict,
+                            norway_ict,
+                            viking_ict
+                        FROM data_warehouse.fact_table''')
+
+def create_schema_fact_table(con, since=None):
 
+    if since is None:
+        key, measure = column_types()
+        # the compact layout derives the ids from timestamp_id instead of storing them three more times
+        alias = f"{key} AS (timestamp_id)" if compact_storage else key
+        con.execute(f'''CREATE OR REPLACE TABLE data_warehouse.fact_table (
+                            fact_id {key} PRIMARY KEY,
+                            time_id {alias},
+                            energy_id {alias},
+                            ict_id {alias},
+                            timestamp_id {key},
+                            time TIMESTAMP,
+                            total_demand {measure},
+                            avg_frequency {measure},
+                            coal {measure},
+                            nuclear {measure},
+                            ccgt {measure},
+                            wind {measure},
+                            pumped {measure},
+                            hydro {measure},
+                            biomass {measure},
+                            oil {measure},
+                            solar {measure},
+                            ocgt {measure},
+                            french_ict {measure},
+                            dutch_ict {measure},
+                            irish_ict {measure},
+                            east_west_ict {measure},
+                            nemo_belgium_ict {measure},
+                            other_generator {measure},
+                            north_south {measure},
+                            scotland_england {measure},
+                            ifa2 {measure},
+                            intelec_ict {measure},
+                            norway_ict {measure},
+                            viking_ict {measure})''')
 
-def get_fact_gridwatch():
+    return con.execute(f'''INSERT OR REPLACE INTO data_warehouse.fact_table BY NAME
+                    SELECT * {generated_columns(con, 'fact_table')}
+                    FROM (
+                    SELECT
+                        timestamp_id AS fact_id,
+                        timestamp_id AS time_id,
+                        timestamp_id AS energy_id,
+                        timestamp_id AS ict_id,
+                        timestamp_id,
+                        time,
+                        demand AS total_demand,
+                        avg_frequency,
+                        coal,
+                        nuclear,
+                        ccgt,
+                        wind,
+                        pumped,
+                        hydro,
+                        biomass,
+                        oil,
+                        solar,
+                        ocgt,
+                        french_ict,
+                        dutch_ict,
+                        irish_ict,
+                        ew_ict AS east_west_ict,
+                        nemo AS nemo_belgium_ict,
+                        other AS other_generator,
+                        north_south,
+                        scotland_england,
+                        ifa2,
+                        intelec_ict,
+                        nsl AS norway_ict,
+                        vkl_ict AS viking_ict
+                    FROM data_warehouse.aggregate_main_table
+                    WHERE $since IS NULL OR time >= $since)
+                    ORDER BY time''', {'since': since}).fetchone()[0]
+
+def create_schema_daily_rollup_table(con, since=None):
+
+    # one row per day for the dashboard charts, demand, frequency and interconnectors are daily
+    # averages of the hourly rows while energy sources, total demand and production are daily sums
+    if since is None:
+        _, measure = column_types()
+        # the compact layout derives the calendar parts from the date instead of storing them
+        parts = {part: f"{CALENDAR_TYPES[part]} AS ({calendar(part, 'date')})" if compact_storage else 'BIGINT'
+                 for part in ('year', 'month', 'day')}
+        con.execute(f'''CREATE OR REPLACE TABLE data_warehouse.daily_rollup_table (
+                            date DATE PRIMARY KEY,
+                            year {parts['year']},
+                            month {parts['month']},
+                            day {parts['day']},
+                            avg_demand {measure},
+                            total_demand {measure},
+                            total_production {measure},
+                            avg_frequency {measure},
+                            coal {measure},
+                            nuclear {measure},
+                            ccgt {measure},
+                            wind {measure},
+                            solar {measure},
+                            pumped {measure},
+                            hydro {measure},
+                            biomass {measure},
+                            oil {measure},
+                            ocgt {measure},
+                            french_ict {measure},
+                            dutch_ict {measure},
+                            irish_ict {measure},
+                            nemo_belgium_ict {measure},
+                            other_generator {measure},
+                            north_south {measure},
+                            scotland_england {measure},
+                            ifa2 {measure},
+                            intelec_ict {measure},
+                            norway_ict {measure},
+                            viking_ict {measure});''')
+
+    # new hours only change their own day, so an incremental build recomputes the days from the
+    # high-water mark onwards and replaces them
+    return con.execute(f'''INSERT OR REPLACE INTO data_warehouse.daily_rollup_table BY NAME
+                    SELECT * {generated_columns(con, 'daily_rollup_table')}
+                    FROM (
+                    SELECT
+                        CAST(time AS DATE) AS date,
+                        EXTRACT(YEAR FROM date) AS year,
+                        EXTRACT(MONTH FROM date) AS month,
+                        EXTRACT(DAY FROM date) AS day,
+                        AVG(demand) AS avg_demand,
+                        SUM(demand) AS total_demand,
+                        SUM(coal + nuclear + ccgt + wind + pumped + hydro +
+                            biomass + oil + solar + ocgt + french_ict + dutch_ict + irish_ict + nemo + other +
+                            north_south + scotland_england + ifa2 + intelec_ict + nsl + vkl_ict) AS total_production,
+                        AVG(avg_frequency) AS avg_frequency,
+                        SUM(coal) AS coal,
+                        SUM(nuclear) AS nuclear,
+                        SUM(ccgt) AS ccgt,
+                        SUM(wind) AS wind,
+                        SUM(solar) AS solar,
+                        SUM(pumped) AS pumped,
+                        SUM(hydro) AS hydro,
+                        SUM(biomass) AS biomass,
+                        SUM(oil) AS oil,
+                        SUM(ocgt) AS ocgt,
+                        AVG(french_ict) AS french_ict,
+                        AVG(dutch_ict) AS dutch_ict,
+                        AVG(irish_ict) AS irish_ict,
+                        AVG(nemo) AS nemo_belgium_ict,
+                        AVG(other) AS other_generator,
+                        AVG(north_south) AS north_south,
+                        AVG(scotland_england) AS scotland_england,
+                        AVG(ifa2) AS ifa2,
+                        AVG(intelec_ict) AS intelec_ict,
+                        AVG(nsl) AS norway_ict,
+                        AVG(vkl_ict) AS viking_ict
+                    FROM data_warehouse.aggregate_main_table
+                    WHERE $since IS NULL OR time >= CAST($since AS DATE)
+                    GROUP BY date)
+                    ORDER BY date''', {'since': since}).fetchone()[0]
+
+def create_schema_hour_of_day_rollup_table(con, since=None):
+
+    # 24 rows averaged over the whole history, every new hour moves the averages so this one is
+    # recomputed on each build, it is a single scan of the hourly table, typed like the fact table it is
+    # built from whatever the compact flag of an incremental run
+    compact = bool(generated_columns(con, 'fact_table'))
+    return con.execute(f'''CREATE OR REPLACE TABLE data_warehouse.hour_of_day_rollup_table AS
+                    SELECT
+                        {calendar('hour', 'time', compact)} AS hour,
+                        AVG(demand) AS avg_demand
+                    FROM data_warehouse.aggregate_main_table
+                    GROUP BY hour
+                    ORDER BY hour''').fetchone()[0]
+
+def create_schema_figure_cache_table(con, since=None):
+
+    # rendering the figures is most of the time of an incremental refresh, which skips it by default
+    if precompute_figures == 'never' or (precompute_figures == 'full' and since is not None):
+        return None
+
+    # every chart over the full history at daily resolution for every moving average window of the app,
+    # serialised so a default page view is a lookup, keyed by the version this build is writing
+    version = get_warehouse_version(con)
+    fetch = connection_fetch(con)
+    figures = []
+    for chart_name, chart in CHARTS.items():
+        for window_size in WINDOW_SIZES:
+            _, fig, description = chart(fetch, window_size)
+            figures.append((chart_name, window_size, version, fig.to_json(), description))
+
+    con.execute('''CREATE OR REPLACE TABLE data_warehouse.figure_cache_table (
+                        chart VARCHAR,
+                        window_size INTEGER,
+                        version BIGINT,
+                        figure VARCHAR,
+                        description VARCHAR,
+                        PRIMARY KEY (chart, window_size));''')
+    con.executemany('INSERT INTO data_warehouse.figure_cache_table VALUES (?, ?, ?, ?, ?)', figures)
+    return len(figures)
+
+# every table of a build in dependency order, each stage takes (con, since)
+BUILD_STAGES = [
+    ('ingested_rows_table', create_schema_ingested_rows_table),
+    ('aggregate_main_table', create_schema_aggregate_main_table),
+    ('fact_table', create_schema_fact_table),
+    ('dim_time_table', create_schema_time_table),
+    ('dim_energy_table', create_schema_energy_table),
+    ('dim_ict_table', create_schema_interconnectors_table),
+    ('daily_rollup_table', create_schema_daily_rollup_table),
+    ('hour_of_day_rollup_table', create_schema_hour_of_day_rollup_table),
+    ('warehouse_state', create_schema_warehouse_state),
+    ('figure_cache_table', create_schema_figure_cache_table),
+]
+
+def get_fact_gridwatch(incremental=False, run_log=None, explain=False):
+
+    # an incremental build re-aggregates from the hour of the high-water mark, so the last partial hour of
+    # the previous build is completed, and falls back to a full rebuild when the warehouse has never been
+    # built, warehouses from before the wide fact table, the time-derived keys or the seen-set are rebuilt
+    # in full once
+    high_water_mark = None
+    version = 0
+    if os.path.exists(warehouse):
+        live = connect_warehouse(warehouse, read_only=True)
+        try:
+            upgraded = incremental and has_wide_fact_table(live) and has_time_keys(live) \
+                and has_table(live, 'ingested_rows_table')
+            high_water_mark = get_high_water_mark(live) if upgraded else None
+            version = get_warehouse_version(live)
+        finally:
+            live.close()
+    since = high_water_mark.replace(minute=0, second=0, microsecond=0) if high_water_mark is not None else None
+
+    # the build writes a staging file and renames it over the live file once it is complete, readers keep
+    # the file they opened until they reopen and never see a half built warehouse or wait on the lock, an
+    # incremental build stages a copy of the live warehouse while a full build starts from an empty file,
+    # so the blocks freed by replacing every table do not bloat it, and only carries the version over
+    staging = staging_path(warehouse)
+    if os.path.exists(staging):
+        os.remove(staging)
+    if since is not None:
+        shutil.copyfile(warehouse, staging)
+
+    # with run_log every stage is timed and every statement profiled by DuckDB into that json file,
+    # explain also replays the slowest statements under EXPLAIN ANALYZE
+    run = RunLog(connect_warehouse(staging), profile=run_log is not None,
+                 raw_data=raw_data, incremental=incremental, high_water_mark=high_water_mark, since=since)
+    con = run.con
+    swap = False
 
-    con = duck.connect('data_warehouse.duckdb')
-    
     try:
-        bigtable = data_cleaning(raw_data)
-        aggregate_main_table = create_schema_aggregate_main_table(con, bigtable)
-        time_table = create_schema_time_table(con, aggregate_main_table)
-        energy_sources = create_schema_energy_table(con, aggregate_main_table)
-        interconnectors = create_schema_interconnectors_table(con, aggregate_main_table)
-        
-        fact_gridwatch = create_schema_fact_table(con, time_table, energy_sources, interconnectors)
-        
-        return fact_gridwatch 
+        if since is None and version:
+            # the version of the empty file goes on from the live one, so readers still drop their caches
+            con.execute('''CREATE TABLE data_warehouse.warehouse_state (
+                                last_timestamp TIMESTAMP,
+                                updated_at TIMESTAMP,
+                                version BIGINT);''')
+            con.execute('INSERT INTO data_warehouse.warehouse_state VALUES (NULL, NULL, ?)', [version])
+
+        with run.stage('data_cleaning'):
+            data_cleaning(con, raw_data, since)
+            changed = since is None or con.execute("SELECT COUNT(*) FROM raw_table WHERE CAST(timestamp AS TIMESTAMP) > ?",
+                                                   [high_water_mark]).fetchone()[0]
+        if not changed:
+            # nothing newer than the last build, leave the warehouse and its version untouched
+            return 0
+
+        con.begin()
+        rows = {name: run.call(name, stage, con, since) for name, stage in BUILD_STAGES}
+        con.commit()
+        run.info['version'] = get_warehouse_version(con)
+        run.info['deduplication'] = get_ingest_report(con)
+
+        # the build is complete, the plans are only captured for the run log
+        swap = True
+        if explain and run_log is not None:
+            run.explain()
+        return rows['fact_table']
     finally:
+        # closing checkpoints the staging file, a failed or empty build is thrown away and the rename is
+        # atomic, a new reader opens either the old warehouse or the new one
         con.close()
+        if swap:
+            os.replace(staging, warehouse)
+        elif os.path.exists(staging):
+            os.remove(staging)
+        if run_log is not None:
+            run.write(run_log)
 
 
 # This block is for testing purposes
 if __name__ == "__main__":
-    fact_gridwatch = get_fact_gridwatch()
-    print(fact_gridwatch)
+    parser = argparse.ArgumentParser(description='Build the Gridwatch data warehouse from the raw parquet data.')
+    parser.add_argument('--raw-data', default=raw_data,
+                        help='raw parquet file, or the partitioned data lake directory written by ingest.py')
+    parser.add_argument('--warehouse', default=warehouse,
+                        help='live warehouse file, the build writes a copy next to it and swaps it in when done')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only ingest raw rows from the last build onwards instead of rebuilding every table')
+    parser.add_argument('--workers', type=int, default=aggregate_workers,
+                        help='aggregate the raw data in chunks of --chunk-months on this many parallel workers')
+    parser.add_argument('--chunk-months', type=int, default=aggregate_chunk_months,
+                        help='calendar months of raw data aggregated by one worker at a time')
+    parser.add_argument('--memory-limit', default=aggregate_memory_limit,
+                        help='DuckDB memory limit of every aggregation worker, e.g. 512MB')
+    parser.add_argument('--compact', action='store_true',
+                        help='store the measures as REAL, the keys as INTEGER and derive the repeated ids and calendar parts')
+    parser.add_argument('--run-log', help='write the timings and DuckDB profile of every build stage to this json file')
+    parser.add_argument('--explain', action='store_true',
+                        help='also capture EXPLAIN ANALYZE of the slowest statements in the run log')
+    parser.add_argument('--figures', choices=FIGURE_MODES, default=precompute_figures,
+                        help='builds that render the figures of the default page view, full builds only by default')
+    args = parser.parse_args()
+    if args.explain and not args.run_log:
+        parser.error('--explain needs --run-log')
 
+    raw_data = args.raw_data
+    warehouse = args.warehouse
+    aggregate_workers = args.workers
+    aggregate_memory_limit = args.memory_limit
+    aggregate_chunk_months = args.chunk_months
+    compact_storage = args.compact
+    precompute_figures = args.figures
+    fact_rows = get_fact_gridwatch(incremental=args.incremental, run_log=args.run_log, explain=args.explain)
+    print(f'{fact_rows} rows written to fact_table')
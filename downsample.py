@@ -0,0 +1,79 @@
+import numpy as np
+
+MAX_POINTS = 1000
+
+def as_float(x):
+    # dates and timestamps are compared through their integer representation
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64) or np.issubdtype(x.dtype, np.timedelta64):
+        return x.astype('int64').astype('float64')
+    return x.astype('float64')
+
+def lttb_indices(x, y, max_points):
+    # Largest-Triangle-Three-Buckets, keeps the first and last point and from every bucket in between
+    # the point forming the largest triangle with the point kept before it and the next bucket's average
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    # averages of every bucket, the last bucket's "next" is the final point
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    avg_x = np.append(sums_x / sizes, x[n - 1])
+    avg_y = np.append(sums_y / sizes, y[n - 1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        bx, by = x[start:end], y[start:end]
+        areas = np.abs((x[a] - avg_x[i + 1]) * (by - y[a]) - (x[a] - bx) * (avg_y[i + 1] - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+def minmax_indices(x, y, max_points):
+    # keeps the minimum and maximum of every bucket, fully vectorised, preserves spikes exactly
+    n = len(x)
+    buckets = max(max_points // 2, 1)
+    if max_points >= n:
+        return np.arange(n)
+
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    lows = offsets + np.nanargmin(padded, axis=1)
+    highs = offsets + np.nanargmax(padded, axis=1)
+    return np.unique(np.concatenate([lows, highs, [0, n - 1]]))
+
+METHODS = {'lttb': lttb_indices, 'minmax': minmax_indices}
+
+def downsample_indices(x, y, max_points=MAX_POINTS, method='lttb'):
+    # missing values (the moving average warm-up) are dropped before bucketing
+    y = np.asarray(y, dtype='float64')
+    valid = np.flatnonzero(~np.isnan(y))
+    if len(valid) == 0:
+        return valid
+    kept = METHODS[method](as_float(x)[valid], y[valid], max_points)
+    return valid[kept]
+
+def downsample_trace(data, x, y, max_points=MAX_POINTS, method='lttb'):
+    indices = downsample_indices(data[x], data[y], max_points, method)
+    return {x: np.asarray(data[x])[indices], y: np.asarray(data[y])[indices]}
+
+def downsample_traces(data, x, ys, max_points=MAX_POINTS, method='lttb'):
+    # long format, one 'variable' per trace and its 'value', each trace bounded to max_points
+    xs, variables, values = [], [], []
+    for y in ys:
+        indices = downsample_indices(data[x], data[y], max_points, method)
+        xs.append(np.asarray(data[x])[indices])
+        values.append(np.asarray(data[y], dtype='float64')[indices])
+        variables.append(np.full(len(indices), y, dtype=object))
+    return {x: np.concatenate(xs), 'variable': np.concatenate(variables), 'value': np.concatenate(values)}
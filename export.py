@@ -0,0 +1,113 @@
+import argparse
+import os
+import pyarrow as pa
+from queries import *
+from charts import DEFAULT_WINDOW_SIZE
+from create_schema import warehouse, connect_warehouse
+
+BATCH_ROWS = 64 * 1024
+PARTITIONS = {'year': ['year'], 'month': ['year', 'month'], 'none': []}
+
+# every export is (query, time column), the smoothed series take the window and the resolution of the
+# dashboard while the stored rows only take the date range, the time column partitions the parquet files
+EXPORTS = {
+    'hourly': (hourly_query, 'time'),
+    'daily': (daily_query, 'date'),
+    'demand_over_time': (demand_over_time_query, 'date'),
+    'energy_contribution': (energy_contribution_query, 'date'),
+    'demand_during_sleep': (demand_during_sleep_query, None),
+    'ict_visualization': (ict_visualization_query, 'date'),
+    'demand_v_production': (demand_v_production_query, 'date'),
+}
+SERIES = ['demand_over_time', 'energy_contribution', 'ict_visualization', 'demand_v_production']
+
+def export_query(name, start=None, end=None, window_size=DEFAULT_WINDOW_SIZE, resolution='daily'):
+    if name not in EXPORTS:
+        raise ValueError(f'export must be one of {", ".join(EXPORTS)}, got {name}')
+    query, _ = EXPORTS[name]
+    if name in SERIES:
+        return query(window_size, start, end, resolution)
+    return query(start, end)
+
+def connect(database=warehouse):
+    # a read-only connection of its own, closed as soon as the export is written or read, so an export
+    # never keeps the file open longer than it reads, a build swapping the file in meanwhile does not
+    # change what the export sees
+    return connect_warehouse(database, read_only=True)
+
+def record_batch_reader(name, start=None, end=None, window_size=DEFAULT_WINDOW_SIZE, resolution='daily',
+                        database=warehouse, batch_rows=BATCH_ROWS):
+    # streams the result as Arrow record batches of batch_rows rows straight from DuckDB, the connection
+    # closes once the reader is exhausted or closed
+    con = connect(database)
+    try:
+        batches = con.execute(export_query(name, start, end, window_size, resolution)).fetch_record_batch(batch_rows)
+    except Exception:
+        con.close()
+        raise
+
+    def stream():
+        try:
+            yield from batches
+        finally:
+            con.close()
+    return pa.RecordBatchReader.from_batches(batches.schema, stream())
+
+def sql_string(value):
+    # a quoted sql literal, e.g. an output path holding a quote
+    return "'" + str(value).replace("'", "''") + "'"
+
+def write_parquet(name, path, start=None, end=None, window_size=DEFAULT_WINDOW_SIZE, resolution='daily',
+                  partition='month', database=warehouse):
+    # written by DuckDB's own COPY, a hive partitioned directory by year or year/month of the time column
+    # like the data lake of ingest.py, or a single file for partition none and the hour of day profile
+    _, column = EXPORTS[name]
+    partitions = PARTITIONS[partition] if column is not None else []
+    query = export_query(name, start, end, window_size, resolution)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = connect(database)
+    try:
+        if not partitions:
+            return con.execute(f"COPY ({query}) TO {sql_string(path)} (FORMAT parquet, COMPRESSION zstd)").fetchone()[0]
+        # the daily rollup already stores year and month, only the parts the rows lack are derived
+        columns = [description[0] for description in con.execute(f"SELECT * FROM ({query}) LIMIT 0").description]
+        derived = ''.join(f", {part.upper()}({column}) AS {part}" for part in partitions if part not in columns)
+        return con.execute(f"""COPY (SELECT *{derived} FROM ({query}))
+                               TO {sql_string(path)} (FORMAT parquet, COMPRESSION zstd,
+                                                      PARTITION_BY ({', '.join(partitions)}), OVERWRITE true)""").fetchone()[0]
+    finally:
+        con.close()
+
+def write_arrow(name, path, start=None, end=None, window_size=DEFAULT_WINDOW_SIZE, resolution='daily',
+                database=warehouse):
+    # an Arrow IPC stream file, written batch by batch so memory stays bounded by one batch
+    rows = 0
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with record_batch_reader(name, start, end, window_size, resolution, database) as reader, \
+            pa.OSFile(path, 'wb') as sink, pa.ipc.new_stream(sink, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the warehouse tables and the dashboard series as parquet or Arrow.')
+    parser.add_argument('export', choices=list(EXPORTS), help='table or dashboard series to export')
+    parser.add_argument('output', help='parquet directory (or file with --partition none), or Arrow IPC file')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--start', help='first day of the range, e.g. 2020-01-01')
+    parser.add_argument('--end', help='last day of the range, inclusive')
+    parser.add_argument('--window-size', type=int, default=DEFAULT_WINDOW_SIZE, help='moving average window of the series')
+    parser.add_argument('--resolution', choices=list(RESOLUTIONS), default='daily', help='period of the series')
+    parser.add_argument('--partition', choices=list(PARTITIONS), default='month', help='parquet partitioning')
+    parser.add_argument('--database', default=warehouse, help='warehouse file to export from')
+    args = parser.parse_args()
+
+    if args.format == 'parquet':
+        rows = write_parquet(args.export, args.output, args.start, args.end, args.window_size, args.resolution,
+                             args.partition, args.database)
+    else:
+        rows = write_arrow(args.export, args.output, args.start, args.end, args.window_size, args.resolution,
+                           args.database)
+    print(f'{rows} rows written to {args.output}')
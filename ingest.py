@@ -0,0 +1,154 @@
+import argparse
+import csv
+import os
+import uuid
+from collections import OrderedDict, defaultdict
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+raw_csv = 'gridwatch.csv'
+data_lake = 'gridwatch_lake'
+
+BATCH_BYTES = 16 * 1024 * 1024
+ROWS_PER_GROUP = 128 * 1024
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# the input is in time order so only the latest partitions are being written at any time
+MAX_OPEN_FILES = 4
+PARTITION_COLUMNS = ['year', 'month']
+
+def normalise_name(name):
+    return name.strip().lower().replace(' ', '_')
+
+def read_header(raw_csv):
+    with open(raw_csv, newline='') as f:
+        return next(csv.reader(f))
+
+def column_types(header):
+    # the id is an integer, the timestamp is parsed after trimming and every reading is a float
+    types = {}
+    for name in header:
+        column = normalise_name(name)
+        if column == 'timestamp':
+            types[name] = pa.string()
+        elif column == 'id':
+            types[name] = pa.int64()
+        else:
+            types[name] = pa.float64()
+    return types
+
+def lake_schema(header):
+    fields = []
+    for name in header:
+        column = normalise_name(name)
+        if column == 'timestamp':
+            fields.append((column, pa.timestamp('s')))
+        elif column == 'id':
+            fields.append((column, pa.int64()))
+        else:
+            fields.append((column, pa.float64()))
+    return pa.schema(fields + [('year', pa.int16()), ('month', pa.int8())])
+
+def normalise_batch(batch, schema):
+    columns = []
+    for name, column in zip(batch.schema.names, batch.columns):
+        if normalise_name(name) == 'timestamp':
+            column = pc.strptime(pc.utf8_trim_whitespace(column), format=TIMESTAMP_FORMAT, unit='s')
+            timestamp = column
+        columns.append(column)
+    columns.append(pc.cast(pc.year(timestamp), pa.int16()))
+    columns.append(pc.cast(pc.month(timestamp), pa.int8()))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def stream_batches(raw_csv, header, schema, block_size=BATCH_BYTES):
+    # open_csv reads one block at a time, so memory stays bounded by block_size whatever the file size
+    reader = pv.open_csv(
+        raw_csv,
+        read_options=pv.ReadOptions(block_size=block_size),
+        convert_options=pv.ConvertOptions(column_types=column_types(header)))
+    for batch in reader:
+        yield normalise_batch(batch, schema)
+
+class PartitionWriter:
+    # writes the batches into the year/month hive partitions, at most max_open_files parquet files are
+    # open and each buffers at most rows_per_group rows, so memory is bounded by those two and not by the
+    # input, a month of 5 minute readings is about 9k rows so it is buffered whole into one row group,
+    # a partition seen again after its file was closed goes to a new file next to it
+
+    def __init__(self, data_lake, schema, max_open_files=MAX_OPEN_FILES, rows_per_group=ROWS_PER_GROUP):
+        self.data_lake = data_lake
+        self.schema = pa.schema([field for field in schema if field.name not in PARTITION_COLUMNS])
+        self.max_open_files = max_open_files
+        self.rows_per_group = rows_per_group
+        self.run = uuid.uuid4().hex
+        self.files = OrderedDict()
+        self.opened = defaultdict(int)
+
+    def write_batch(self, batch):
+        table = pa.Table.from_batches([batch])
+        partitions = table.select(PARTITION_COLUMNS).group_by(PARTITION_COLUMNS).aggregate([])
+        for year, month in zip(partitions['year'].to_pylist(), partitions['month'].to_pylist()):
+            rows = table.filter(pc.and_(pc.equal(table['year'], year), pc.equal(table['month'], month)))
+            self.append((year, month), rows.drop_columns(PARTITION_COLUMNS))
+
+    def append(self, partition, table):
+        if partition not in self.files:
+            if len(self.files) >= self.max_open_files:
+                # the least recently written partition, the input is in time order so it is usually done
+                self.close_file(next(iter(self.files)))
+            self.files[partition] = {'writer': self.open_file(partition), 'pending': [], 'rows': 0}
+        self.files.move_to_end(partition)
+        file = self.files[partition]
+        file['pending'].append(table)
+        file['rows'] += table.num_rows
+        if file['rows'] >= self.rows_per_group:
+            self.flush(partition)
+
+    def open_file(self, partition):
+        year, month = partition
+        directory = os.path.join(self.data_lake, f'year={year}', f'month={month}')
+        os.makedirs(directory, exist_ok=True)
+        # every run writes its own files, a rerun over newer csv exports adds files next to the old ones
+        # and the duplicates are dropped by create_schema.data_cleaning
+        path = os.path.join(directory, f'part-{self.run}-{self.opened[partition]}.parquet')
+        self.opened[partition] += 1
+        return pq.ParquetWriter(path, self.schema, compression='zstd', write_statistics=True)
+
+    def flush(self, partition):
+        file = self.files[partition]
+        if file['pending']:
+            file['writer'].write_table(pa.concat_tables(file['pending']), row_group_size=self.rows_per_group)
+        file['pending'] = []
+        file['rows'] = 0
+
+    def close_file(self, partition):
+        self.flush(partition)
+        self.files.pop(partition)['writer'].close()
+
+    def close(self):
+        for partition in list(self.files):
+            self.close_file(partition)
+
+def csv_to_data_lake(raw_csv=raw_csv, data_lake=data_lake, block_size=BATCH_BYTES, max_open_files=MAX_OPEN_FILES):
+    header = read_header(raw_csv)
+    schema = lake_schema(header)
+    writer = PartitionWriter(data_lake, schema, max_open_files)
+    try:
+        for batch in stream_batches(raw_csv, header, schema, block_size):
+            writer.write_batch(batch)
+    finally:
+        writer.close()
+    return data_lake
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the raw Gridwatch csv into a year/month partitioned parquet data lake.')
+    parser.add_argument('raw_csv', nargs='?', default=raw_csv, help='raw Gridwatch csv export')
+    parser.add_argument('--output', default=data_lake, help='directory of the partitioned parquet dataset')
+    parser.add_argument('--block-size', type=int, default=BATCH_BYTES, help='bytes of csv read per record batch')
+    parser.add_argument('--max-open-files', type=int, default=MAX_OPEN_FILES, help='partition files open at once')
+    args = parser.parse_args()
+
+    print(csv_to_data_lake(args.raw_csv, args.output, args.block_size, args.max_open_files))
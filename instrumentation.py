@@ -0,0 +1,270 @@
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows has no getrusage, the peak is then only known where /proc is
+    resource = None
+
+# statements replayed under EXPLAIN ANALYZE when a run asks for the plans
+EXPLAIN_TOP = 3
+
+logger = logging.getLogger('gridwatch.build')
+
+def current_rss():
+    # resident set size in bytes, read from /proc where it exists
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def max_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class PeakMemory:
+    # samples the resident set size while a stage runs, the peak then covers DuckDB's own allocations
+    # too, without /proc it falls back to the peak of the whole process so far and without either it is None
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+
+    def sample(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, current_rss() or 0)
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss() or 0
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        rss = current_rss()
+        self.peak = max(self.peak, rss) if rss is not None else max_rss()
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / 2 ** 20, 1) if self.peak is not None else None
+
+# scans that read a table, a parquet/csv file or an arrow table registered from python, the catalog
+# functions the stages call, e.g. duckdb_columns(), are not rows of the data
+CATALOG_SCANS = ('DUCKDB_', 'PRAGMA_')
+
+def scanned_rows(profile):
+    # rows produced by the scans of the plan, cumulative_rows_scanned only counts the rows read from
+    # the files and is 0 for a statement that reads DuckDB tables
+    rows = 0
+    def walk(node):
+        nonlocal rows
+        if node.get('operator_type') == 'TABLE_SCAN':
+            function = (node.get('extra_info') or {}).get('Function', '')
+            if not function.startswith(CATALOG_SCANS):
+                rows += node.get('operator_cardinality', 0)
+        for child in node.get('children', []):
+            walk(child)
+    walk(profile)
+    return rows
+
+def operator_timings(profile):
+    # seconds spent per operator type over the whole plan, e.g. READ_PARQUET against HASH_GROUP_BY
+    timings = defaultdict(float)
+    def walk(node):
+        if node.get('operator_type'):
+            timings[node['operator_type']] += node.get('operator_timing', 0.0)
+        for child in node.get('children', []):
+            walk(child)
+    walk(profile)
+    return {operator: round(seconds, 6) for operator, seconds in sorted(timings.items(), key=lambda item: -item[1])}
+
+class ProfiledConnection:
+    # wraps a DuckDB connection so DuckDB's own json profile of every executed statement is kept
+    # with the stage that ran it, anything else is passed through to the connection
+
+    def __init__(self, con, run):
+        self.con = con
+        self.run = run
+        self.profile_path = os.path.join(tempfile.mkdtemp(prefix='gridwatch-profile-'), 'profile.json')
+        con.execute("SET enable_profiling = 'json'")
+        con.execute(f"SET profiling_output = '{self.profile_path}'")
+
+    def collect(self):
+        # DuckDB writes the profile once a statement's result is consumed, for a fetchone() only when
+        # the next statement runs, so the profile is matched back to its statement by the query text
+        try:
+            with open(self.profile_path) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            return
+        finally:
+            if os.path.exists(self.profile_path):
+                os.remove(self.profile_path)
+        self.run.attach_profile(profile)
+
+    def execute(self, query, parameters=None):
+        self.collect()
+        start = time.perf_counter()
+        result = self.con.execute(query, parameters)
+        self.run.record_statement(query, parameters, time.perf_counter() - start)
+        self.collect()
+        return result
+
+    def register(self, name, data):
+        # a python object registered as a view is gone by the time explain replays the statements reading it
+        self.run.registered.add(name)
+        return self.con.register(name, data)
+
+    def close(self):
+        # closing the connection writes the profile of a result still open
+        self.con.close()
+        self.collect()
+        os.rmdir(os.path.dirname(self.profile_path))
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+class RunLog:
+    # wall time, cpu time, rows in/out and peak memory of every stage of a build, and with profile
+    # set the DuckDB profile of every statement of the stage, written as one json document
+
+    def __init__(self, con, profile=False, **info):
+        self.con = ProfiledConnection(con, self) if profile else con
+        self.profile = profile
+        self.info = info
+        self.stages = []
+        self.current = None
+        self.started = time.time()
+        self.explained = []
+        self.registered = set()
+
+    def record_statement(self, query, parameters, wall):
+        if self.current is None:
+            return
+        statement = {'sql': ' '.join(query.split()), 'wall_s': round(wall, 6)}
+        if parameters:
+            statement['parameters'] = {key: str(value) for key, value in parameters.items()} \
+                if isinstance(parameters, dict) else [str(value) for value in parameters]
+        self.current['statements'].append(statement)
+        self.current['queries'].append((query, parameters))
+
+    def attach_profile(self, profile):
+        # the latest statement with this text that has no profile yet
+        for stage in reversed(self.stages + ([self.current] if self.current is not None else [])):
+            for statement, (query, _) in reversed(list(zip(stage['statements'], stage['queries']))):
+                if query == profile.get('query_name') and 'profile' not in statement:
+                    statement.update({
+                        'latency_s': round(profile.get('operator_timing', 0.0), 6),
+                        'cpu_s': round(profile.get('cpu_time', 0.0), 6),
+                        'rows_scanned': scanned_rows(profile),
+                        'operators': operator_timings(profile),
+                        'profile': profile,
+                    })
+                    return
+
+    @contextmanager
+    def stage(self, name):
+        entry = {'name': name, 'statements': [], 'queries': [], 'rows_out': None}
+        self.current = entry
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            with PeakMemory() as memory:
+                yield entry
+        finally:
+            entry['wall_s'] = round(time.perf_counter() - start, 6)
+            # process time counts every DuckDB worker thread, so it can exceed the wall time
+            entry['cpu_s'] = round(time.process_time() - cpu, 6)
+            entry['peak_rss_mb'] = memory.peak_mb
+            self.current = None
+            self.stages.append(entry)
+
+    def call(self, name, function, *args):
+        with self.stage(name) as entry:
+            result = function(*args)
+            if isinstance(result, int):
+                entry['rows_out'] = result
+        return result
+
+    def replayable(self, query):
+        # a statement reading an arrow table the build registered and unregistered again can not be replayed
+        return not any(re.search(rf'\b{re.escape(name)}\b', query) for name in self.registered)
+
+    def explain(self, top=EXPLAIN_TOP):
+        # replays the slowest statements under EXPLAIN ANALYZE after the build, each in a transaction that
+        # is rolled back, together with the statements of its stage that ran before it so the plan sees
+        # the tables as they were, e.g. the freshly created table a full build inserts into, a statement
+        # that fails to replay is logged with its error and never fails the build
+        statements = [(stage, index) for stage in self.stages for index in range(len(stage['statements']))
+                      if all(self.replayable(query) for query, _ in stage['queries'][:index + 1])]
+        # ranked on DuckDB's own latency where there is a profile, the wall time also counts python
+        statements.sort(key=lambda item: -item[0]['statements'][item[1]].get('latency_s', item[0]['statements'][item[1]]['wall_s']))
+        con = self.con.con if self.profile else self.con
+        if self.profile:
+            self.con.collect()
+        con.execute("SET enable_profiling = 'query_tree'")
+        con.execute("PRAGMA disable_profiling")
+        try:
+            for stage, index in statements[:top]:
+                entry = {'stage': stage['name'], 'sql': stage['statements'][index]['sql']}
+                try:
+                    con.begin()
+                    try:
+                        for query, parameters in stage['queries'][:index]:
+                            con.execute(query, parameters)
+                        query, parameters = stage['queries'][index]
+                        entry['plan'] = con.execute(f"EXPLAIN ANALYZE {query}", parameters).fetchall()[0][1]
+                    finally:
+                        con.rollback()
+                except Exception as error:
+                    logger.warning('EXPLAIN ANALYZE of %s failed: %s', entry['sql'][:200], error)
+                    entry['error'] = str(error)
+                self.explained.append(entry)
+        finally:
+            if self.profile:
+                con.execute("SET enable_profiling = 'json'")
+
+    def stage_report(self, stage):
+        # rows in is what DuckDB scanned for the stage, known once every profile has been collected
+        scanned = [statement['rows_scanned'] for statement in stage['statements'] if statement.get('rows_scanned') is not None]
+        return {
+            'name': stage['name'],
+            'wall_s': stage['wall_s'],
+            'cpu_s': stage['cpu_s'],
+            'peak_rss_mb': stage['peak_rss_mb'],
+            'rows_in': sum(scanned) if scanned else None,
+            'rows_out': stage['rows_out'],
+            'statements': stage['statements'],
+        }
+
+    def report(self):
+        return {
+            **self.info,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'wall_s': round(sum(stage['wall_s'] for stage in self.stages), 6),
+            'peak_rss_mb': max((stage['peak_rss_mb'] for stage in self.stages if stage['peak_rss_mb'] is not None), default=None),
+            'stages': [self.stage_report(stage) for stage in self.stages],
+            'explain_analyze': self.explained,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        return path
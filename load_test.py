@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+import numpy as np
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from charts import WINDOW_SIZES
+
+URL = 'http://127.0.0.1:8000'
+CLIENTS = [1, 8, 32]
+DURATION = 10
+PERCENTILES = [50, 95, 99]
+# the dashboard series, asked for with a random window, resolution and one in RANGE_SHARE requests
+# with a random date range, the rest over the whole history as the default page view does
+SERIES = ['demand_over_time', 'energy_contribution', 'demand_during_sleep', 'ict_visualization',
+          'demand_v_production']
+RESOLUTIONS = ['daily', 'daily', 'daily', 'weekly', 'monthly']
+RANGE_SHARE = 0.2
+FIRST_DAY = date(2012, 1, 1)
+RANGE_DAYS = 365 * 12
+
+def random_request(rng, arrow):
+    name = rng.choice(SERIES)
+    params = {'window_size': rng.choice(WINDOW_SIZES), 'resolution': rng.choice(RESOLUTIONS)}
+    if rng.random() < RANGE_SHARE:
+        start = FIRST_DAY + timedelta(days=rng.randrange(RANGE_DAYS))
+        params.update(start=start.isoformat(), end=(start + timedelta(days=rng.randrange(7, 365))).isoformat())
+    if arrow:
+        params['format'] = 'arrow'
+    return f'/query/{name}?{urlencode(params)}'
+
+async def client(http, url, deadline, rng, arrow, results):
+    # one client sends its next request as soon as the last one is answered, like a user clicking through
+    while time.perf_counter() < deadline:
+        path = random_request(rng, arrow)
+        start = time.perf_counter()
+        try:
+            response = await http.fetch(url + path, request_timeout=60)
+            results.append((time.perf_counter() - start, len(response.body), None))
+        except (HTTPClientError, OSError) as error:
+            results.append((time.perf_counter() - start, 0, f'{type(error).__name__}: {error}'))
+
+async def run_load(url, clients, duration, arrow, seed):
+    http = AsyncHTTPClient(max_clients=clients)
+    results = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(client(http, url, deadline, random.Random(seed + index), arrow, results)
+                           for index in range(clients)))
+    wall = time.perf_counter() - start
+    latencies = [latency for latency, _, error in results if error is None]
+    errors = [error for _, _, error in results if error is not None]
+    return {
+        'clients': clients,
+        'requests': len(results),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(results) / wall, 1),
+        'mb_per_sec': round(sum(size for _, size, _ in results) / wall / 2 ** 20, 2),
+        **{f'latency_p{p}_ms': round(1000 * float(np.percentile(latencies, p)), 2) if latencies else None
+           for p in PERCENTILES},
+        'latency_max_ms': round(1000 * max(latencies), 2) if latencies else None,
+    }
+
+async def run_load_test(url=URL, clients=CLIENTS, duration=DURATION, arrow=False, seed=42):
+    return {
+        'url': url,
+        'format': 'arrow' if arrow else 'json',
+        'duration_s': duration,
+        'runs': [await run_load(url, count, duration, arrow, seed) for count in clients],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test the query API with concurrent clients.')
+    parser.add_argument('--url', default=URL, help='base url of api.py')
+    parser.add_argument('--clients', type=int, nargs='+', default=CLIENTS, help='concurrent clients of every run')
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds of every run')
+    parser.add_argument('--arrow', action='store_true', help='ask for Arrow IPC instead of JSON')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args.url, args.clients, args.duration, args.arrow, args.seed))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
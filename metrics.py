@@ -0,0 +1,97 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import numpy as np
+
+# page builds kept per chart for the percentiles
+HISTORY = 500
+PERCENTILES = [50, 95]
+
+logger = logging.getLogger('gridwatch.render')
+
+class ChartTimer:
+    # phase timings and payload sizes of one chart on one page build
+
+    def __init__(self, chart):
+        self.chart = chart
+        self.phases = {}
+        self.sizes = {}
+        self.error = None
+        self.started = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def size(self, name, value):
+        self.sizes[name] = self.sizes.get(name, 0) + int(value)
+
+    def finish(self, error=None):
+        self.total = time.perf_counter() - self.started
+        self.error = error
+
+    def as_dict(self):
+        return {
+            'chart': self.chart,
+            'total_ms': round(1000 * self.total, 3) if self.total is not None else None,
+            'phases_ms': {name: round(1000 * seconds, 3) for name, seconds in self.phases.items()},
+            'sizes': dict(self.sizes),
+            'error': self.error,
+        }
+
+class RenderMetrics:
+    # the last HISTORY page builds of every chart, shared by every session of the app, each build is
+    # also logged as one json line on the gridwatch.render logger
+
+    def __init__(self, history=HISTORY):
+        self.lock = threading.Lock()
+        self.builds = defaultdict(lambda: deque(maxlen=history))
+        self.failures = defaultdict(int)
+
+    def record(self, timer):
+        entry = timer.as_dict()
+        with self.lock:
+            self.builds[timer.chart].append(entry)
+            if timer.error is not None:
+                self.failures[timer.chart] += 1
+        if timer.error is None:
+            logger.info(json.dumps(entry))
+        else:
+            logger.error(json.dumps(entry))
+        return entry
+
+    def snapshot(self):
+        # p50/p95 of the total and of every phase per chart, in milliseconds
+        with self.lock:
+            builds = {chart: list(entries) for chart, entries in self.builds.items()}
+            failures = dict(self.failures)
+        charts = {}
+        for chart, entries in builds.items():
+            timings = defaultdict(list)
+            for entry in entries:
+                if entry['error'] is None:
+                    timings['total'].append(entry['total_ms'])
+                    for name, ms in entry['phases_ms'].items():
+                        timings[name].append(ms)
+            charts[chart] = {
+                'builds': len(entries),
+                'failures': failures.get(chart, 0),
+                **{f'{name}_p{p}_ms': round(float(np.percentile(values, p)), 3)
+                   for name, values in timings.items() for p in PERCENTILES},
+            }
+        return charts
+
+    def clear(self):
+        with self.lock:
+            self.builds.clear()
+            self.failures.clear()
+
+render_metrics = RenderMetrics()
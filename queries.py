@@ -1,102 +1,180 @@
 # queries.py
 
-# calculate demand of electricity over time
-def demand_over_time_query():
-    return """
-        SELECT 
-            dim_time_table.year,
-            dim_time_table.month,
-            dim_time_table.day,
-            AVG(fact_table.total_demand) AS total_demand
-        FROM data_warehouse.fact_table AS fact_table
-        JOIN data_warehouse.dim_time_table AS dim_time_table
-            ON fact_table.time_id = dim_time_table.time_id
-        GROUP BY dim_time_table.year, dim_time_table.month, dim_time_table.day
-        ORDER BY dim_time_table.year, dim_time_table.month, dim_time_table.day
+from datetime import date
+
+# the daily charts read daily_rollup_table and the hour of day chart reads hour_of_day_rollup_table,
+# both are materialised by create_schema.py so no query joins or groups the hourly rows,
+# hourly resolution reads the wide fact table and weekly/monthly roll the daily table up
+
+ENERGY_SOURCES = ['coal', 'nuclear', 'ccgt', 'wind', 'solar', 'pumped', 'hydro', 'biomass', 'oil', 'ocgt']
+INTERCONNECTORS = ['french_ict', 'dutch_ict', 'irish_ict', 'nemo_belgium_ict', 'other_generator', 'north_south',
+                   'scotland_england', 'ifa2', 'intelec_ict', 'norway_ict', 'viking_ict']
+
+RESOLUTIONS = {'hourly': 'HOUR', 'daily': 'DAY', 'weekly': 'WEEK', 'monthly': 'MONTH'}
+
+# how a daily rollup column combines into weeks and months, the same as it combines hours into days
+ROLLUP_AGGREGATES = {
+    'avg_demand': 'AVG',
+    'total_demand': 'SUM',
+    'total_production': 'SUM',
+    'avg_frequency': 'AVG',
+    **{source: 'SUM' for source in ENERGY_SOURCES},
+    **{ict: 'AVG' for ict in INTERCONNECTORS},
+}
+
+# the daily rollup columns read from the wide hourly fact table, a single table scan
+HOURLY_SOURCE = f"""
+            SELECT
+                time AS date,
+                total_demand AS avg_demand,
+                total_demand,
+                {' + '.join(ENERGY_SOURCES + INTERCONNECTORS)} AS total_production,
+                avg_frequency,
+                {', '.join(ENERGY_SOURCES)},
+                {', '.join(INTERCONNECTORS)}
+            FROM data_warehouse.fact_table"""
+
+def sql_date(value):
+    # accepts a date, a datetime or an iso string, anything else is rejected before it reaches the sql
+    return f"DATE '{date.fromisoformat(str(value)[:10]).isoformat()}'"
+
+def resolution_name(resolution):
+    resolution = str(resolution).lower()
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f'resolution must be one of {", ".join(RESOLUTIONS)}, got {resolution}')
+    return resolution
+
+def date_range_filter(start=None, end=None, column='date', warm_up=None, period=None):
+    # end is inclusive of the whole day, period moves start back to the start of its hour/day/week/month
+    # and warm_up is an interval read before that so the moving average of the first periods in the
+    # range still has a full window
+    conditions = []
+    if start is not None:
+        lower = sql_date(start)
+        if period is not None:
+            lower = f"CAST(DATE_TRUNC('{period}', {lower}) AS DATE)"
+        if warm_up is not None:
+            lower = f"{lower} - {warm_up}"
+        conditions.append(f"{column} >= {lower}")
+    if end is not None:
+        conditions.append(f"{column} < {sql_date(end)} + INTERVAL 1 DAY")
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+def period_source(columns, resolution, start=None, end=None, warm_up=None):
+    # the range is applied on the stored time/date column, before weeks and months are grouped, so
+    # DuckDB can skip the row groups outside it and a period only sums the days up to end
+    resolution = resolution_name(resolution)
+    period = RESOLUTIONS[resolution].lower()
+    if resolution == 'hourly':
+        return f"""{HOURLY_SOURCE}
+            {date_range_filter(start, end, column='time', warm_up=warm_up, period=period)}"""
+    if resolution == 'daily':
+        return f"""
+            SELECT * FROM data_warehouse.daily_rollup_table
+            {date_range_filter(start, end, warm_up=warm_up, period=period)}"""
+    sources = ',\n'.join(f"{ROLLUP_AGGREGATES[source]}({source}) AS {source}" for _, source in columns)
+    return f"""
+            SELECT
+                CAST(DATE_TRUNC('{period}', date) AS DATE) AS date,
+                {sources}
+            FROM data_warehouse.daily_rollup_table
+            {date_range_filter(start, end, warm_up=warm_up, period=period)}
+            GROUP BY 1"""
+
+def moving_average(columns, window_size):
+    # same as pandas rolling(window_size).mean(), NULL until the window holds window_size values
+    window_size = int(window_size)
+    if window_size < 1:
+        raise ValueError(f'window_size must be at least 1, got {window_size}')
+    frame = f"(ORDER BY date ROWS BETWEEN {window_size - 1} PRECEDING AND CURRENT ROW)"
+    return ',\n'.join(
+        f"CASE WHEN COUNT({source}) OVER {frame} = {window_size} THEN AVG({source}) OVER {frame} END AS {name}"
+        for name, source in columns)
+
+def smoothed_query(columns, window_size, start=None, end=None, resolution='daily'):
+    # only window_size - 1 periods before the period holding start are read to fill the first windows
+    resolution = resolution_name(resolution)
+    period = RESOLUTIONS[resolution].lower()
+    names = ', '.join(name for name, _ in columns)
+    warm_up = f"INTERVAL {max(int(window_size) - 1, 0)} {RESOLUTIONS[resolution]}"
+    return f"""
+        WITH periods AS (
+            {period_source(columns, resolution, start, end, warm_up)}
+        ),
+        smoothed AS (
+            SELECT
+                date,
+                {moving_average(columns, window_size)}
+            FROM periods
+        )
+        SELECT date, {names}
+        FROM smoothed
+        {date_range_filter(start, period=period)}
+        ORDER BY date
     """
 
-# calculate trend of enery over time
-def energy_contribution_query():
+def date_bounds_query():
     return """
-        SELECT 
-            dim_time_table.year,
-            dim_time_table.month,
-            dim_time_table.day,
-            SUM(dim_energy_table.coal) AS coal,
-            SUM(dim_energy_table.nuclear) AS nuclear,
-            SUM(dim_energy_table.ccgt) AS ccgt,
-            SUM(dim_energy_table.wind) AS wind,
-            SUM(dim_energy_table.solar) AS solar,
-            SUM(dim_energy_table.pumped) AS pumped,
-            SUM(dim_energy_table.hydro) AS hydro,
-            SUM(dim_energy_table.biomass) AS biomass,
-            SUM(dim_energy_table.oil) AS oil,
-            SUM(dim_energy_table.ocgt) AS ocgt
-        FROM data_warehouse.fact_table AS fact_table
-        JOIN data_warehouse.dim_time_table AS dim_time_table
-            ON fact_table.time_id = dim_time_table.time_id
-        JOIN data_warehouse.dim_energy_table AS dim_energy_table
-            ON fact_table.energy_id = dim_energy_table.energy_id
-        GROUP BY dim_time_table.year, dim_time_table.month, dim_time_table.day
-        ORDER BY dim_time_table.year, dim_time_table.month, dim_time_table.day
+        SELECT MIN(date) AS first_date, MAX(date) AS last_date
+        FROM data_warehouse.daily_rollup_table
     """
 
-def demand_during_sleep_query():
-    return """
-            SELECT 
-                dim_time_table.hour,
-                AVG(fact_table.total_demand) AS avg_demand
+# calculate demand of electricity over time
+def demand_over_time_query(window_size, start=None, end=None, resolution='daily'):
+    return smoothed_query([('smoothed_demand', 'avg_demand')], window_size, start, end, resolution)
+
+# calculate trend of enery over time
+def energy_contribution_query(window_size, start=None, end=None, resolution='daily'):
+    return smoothed_query([(source, source) for source in ENERGY_SOURCES], window_size, start, end, resolution)
+
+def demand_during_sleep_query(start=None, end=None):
+    if start is None and end is None:
+        return """
+            SELECT
+                hour,
+                avg_demand
+            FROM data_warehouse.hour_of_day_rollup_table
+            ORDER BY hour
+            """
+    return f"""
+            SELECT
+                EXTRACT(HOUR FROM time) AS hour,
+                AVG(total_demand) AS avg_demand
             FROM data_warehouse.fact_table
-            JOIN data_warehouse.dim_time_table
-                ON fact_table.time_id = dim_time_table.timestamp_id
+            {date_range_filter(start, end, column='time')}
             GROUP BY hour
             ORDER BY hour
             """
 
-def ict_visualization_query():
-    return """
-        SELECT
-            dim_time_table.year,
-            dim_time_table.month,
-            dim_time_table.day,
-            AVG(dim_ict_table.french_ict) AS french_ict,
-            AVG(dim_ict_table.dutch_ict) AS dutch_ict,
-            AVG(dim_ict_table.irish_ict) AS irish_ict,
-            AVG(dim_ict_table.nemo_belgium_ict) AS nemo_belgium_ict,
-            AVG(dim_ict_table.other_generator) AS other_generator,
-            AVG(dim_ict_table.north_south) AS north_south,
-            AVG(dim_ict_table.scotland_england) AS scotland_england,
-            AVG(dim_ict_table.ifa2) AS ifa2,
-            AVG(dim_ict_table.intelec_ict) AS intelec_ict,
-            AVG(dim_ict_table.norway_ict) AS norway_ict,
-            AVG(dim_ict_table.viking_ict) AS viking_ict
+def ict_visualization_query(window_size, start=None, end=None, resolution='daily'):
+    return smoothed_query([(ict, ict) for ict in INTERCONNECTORS], window_size, start, end, resolution)
+
+def demand_v_production_query(window_size, start=None, end=None, resolution='daily'):
+    return smoothed_query([('total_demand', 'total_demand'), ('total_production', 'total_production')],
+                          window_size, start, end, resolution)
+
+def figure_cache_query(chart, window_size, version):
+    # the figure the build precomputed for the chart at this window over the full history at daily resolution
+    chart = chart.replace("'", "''")
+    return f"""
+        SELECT figure, description
+        FROM data_warehouse.figure_cache_table
+        WHERE chart = '{chart}' AND window_size = {int(window_size)} AND version = {int(version)}
+    """
+
+# the stored hourly and daily rows, for the exports
+def hourly_query(start=None, end=None):
+    return f"""
+        SELECT * EXCLUDE (fact_id, time_id, energy_id, ict_id)
         FROM data_warehouse.fact_table
-        JOIN data_warehouse.dim_time_table
-            ON fact_table.time_id = dim_time_table.timestamp_id
-        JOIN data_warehouse.dim_ict_table 
-            ON fact_table.time_id = dim_ict_table.timestamp_id 
-        GROUP BY dim_time_table.year, dim_time_table.month, dim_time_table.day
-        ORDER BY dim_time_table.year, dim_time_table.month, dim_time_table.day
-        """
-
-def demand_v_production_query():
-    return """
-    SELECT 
-        dim_time_table.year,
-        dim_time_table.month,
-        dim_time_table.day,
-        SUM(fact_table.total_demand) AS total_demand,
-        SUM(p.coal + p.nuclear + p.ccgt + p.wind + p.pumped + p.hydro + 
-            p.biomass + p.oil + p.solar + p.ocgt + ict.french_ict + ict.dutch_ict + ict.irish_ict + ict.nemo_belgium_ict + ict.other_generator +
-            ict.north_south + ict.scotland_england + ict.ifa2 + ict.intelec_ict + ict.norway_ict + ict.viking_ict) AS total_production,
-        AVG(fact_table.avg_frequency) AS avg_frequency 
-    FROM fact_table          
-    JOIN dim_energy_table AS p
-        ON fact_table.time_id = p.timestamp_id
-    JOIN dim_time_table
-        ON fact_table.time_id = dim_time_table.timestamp_id
-    JOIN dim_ict_table AS ict
-        ON fact_table.time_id = ict.timestamp_id
-    GROUP BY dim_time_table.year, dim_time_table.month, dim_time_table.day
-    ORDER BY dim_time_table.year, dim_time_table.month, dim_time_table.day;
-    """
\ No newline at end of file
+        {date_range_filter(start, end, column='time')}
+        ORDER BY time
+    """
+
+def daily_query(start=None, end=None):
+    return f"""
+        SELECT *
+        FROM data_warehouse.daily_rollup_table
+        {date_range_filter(start, end)}
+        ORDER BY date
+    """
@@ -1,9 +1,11 @@
 import concurrent.futures
-import streamlit as st
 import duckdb as duck
-import pandas as pd
-import plotly.express as px
+import streamlit as st
+import plotly.io as pio
 from queries import *
+from warehouse import figure_cache, fetch_cached, warehouse_version, pool, query_cache
+from charts import CHARTS, DEFAULT_WINDOW_SIZE, PERIODS, WINDOW_SIZES, arrays
+from metrics import ChartTimer, logger, render_metrics
 
 #######################
 # Page configuration
@@ -22,106 +24,58 @@ Welcome to the **UK Electricity Demand Dashboard**, this dashboard provide insig
 """)
 st.markdown("<br>", unsafe_allow_html=True)
 
-def fetch_data(query):
-    with duck.connect('data_warehouse.duckdb') as con:
-        return con.execute(query).fetchdf()
-
-def demand_over_time(window_size):
-    df = fetch_data(demand_over_time_query())
-    df['date'] = pd.to_datetime(df[['year', 'month', 'day']])
-    df.set_index('date', inplace=True)
-    df_daily = df.resample('D').mean()
-    df_daily['smoothed_demand'] = df_daily['total_demand'].rolling(window=window_size).mean()
-    df_daily.reset_index(inplace=True)
-
-    fig = px.line(df_daily, x='date', y='smoothed_demand', 
-                  title=f'Electricity demand vs Time ({window_size}-Day Moving Average)',
-                  labels={'smoothed_demand': 'Electricity  Demand (GW)', 'date': 'Time'})
-    fig.update_traces(line=dict(width=1.2))
-
-    return "Total Electricity Demand Over Time", fig, f"This chart shows the total electricity demand over time, smoothed using a {window_size}-day moving average. \
-            Throughout the time, we can see overall the electricity demand is growing smaller each year. \
-            We can also observed significant dip during year 2020, probably due to the pandemic COVID-19 that impacted the electricity supply."
-
-def energy_contribution(window_size):
-    df = fetch_data(energy_contribution_query())
-    df['date'] = pd.to_datetime(df[['year', 'month', 'day']])
-    df.set_index('date', inplace=True)
-    rolling_data = df.rolling(window_size).mean()
-    rolling_data.reset_index(inplace=True)
-
-    fig = px.line(  rolling_data, x='date', y=rolling_data.columns[4:], 
-                    title=f'Energy sources comparison ({window_size}-Day Moving Average)',
-                    labels={'value': 'Energy', 'date': 'Time'})
-    
-    return "Average Energy Sources Trend", fig, f"This chart shows the contribution of various energy sources over time using a {window_size}-day moving average. \
-                                                    There is a clear downtrend of non renewable energy sources such as coal and oil. \
-                                                    While at the same time there is an uptrend of renewable energy sources such as solar, biomass and wind. \
-                                                    Overall majority of renewable energy sources have a consistent increasing growing trend."
-
-def demand_during_sleep():
-    df = fetch_data(demand_during_sleep_query())
-    fig = px.line(df, x='hour', y='avg_demand')
-    return "Electricity Demand Per Day", fig, "This chart depicts the average electricity demand during sleep hours . \
-        This simple chart illustrate the polar relationship between electricity every day. \
-            It can be clearly seen that the electricity demand starts to spike around 9am which is commonly the start working hours and peaked at around 6pm of the day. \
-                The electricity demand then will drop aligning with them time of people sleeping. \
-                     The demand also have little dip around 12pm-2pm which marks the common time of people having a break from their work. "
-
-def ict_visualization(window_size):
-    df = fetch_data(ict_visualization_query())
-    df['date'] = pd.to_datetime(df[['year', 'month', 'day']])
-    df.set_index('date', inplace=True)
-    rolling_data = df.rolling(window_size).mean()
-    rolling_data.reset_index(inplace=True)
-    fig = px.line(  rolling_data, x='date', y=rolling_data.columns[4:], 
-                    title=f'Average Interconnector Flows Over Time ({window_size}-Day Moving Average)',
-                    labels={'value': 'Average Flow', 'date': 'Date'})
-    
-    return "Interconnectors Comparison", fig, "This chart shows the average flows of various interconnectors over time. \
-        This chart illustrate the flows of in and out of interconnectors in the UK. \
-            We can also see north south interconnector contribute the highest average amount of electricity."
-
-def demand_v_production(window_size):
-    df = fetch_data(demand_v_production_query())
-    df['date'] = pd.to_datetime(df[['year', 'month', 'day']])
-    numeric_columns = ['total_demand', 'total_production', 'avg_frequency']
-    rolling_data = df[numeric_columns].rolling(window_size).mean()
-    rolling_data['date'] = df['date']
-    rolling_data.reset_index(drop=False, inplace=True)
-
-    fig = px.line(  rolling_data, x='date', y=['total_demand', 'total_production'],
-                    title=f'Yearly Electricity Demand vs Production ({window_size}-Day Moving Average)',
-                    labels={'value': 'Electricity (GW)', 'date': 'Date'},
-                    color_discrete_sequence=['blue', 'orange'])
-    return "Demand vs Production", fig, "This chart compares the yearly electricity demand against the total production. \
-        Overall bigger picture is for quite some time, total electricity produce is larger than total demand needed which is always good in case of supplying backup electricity due to blackout. \
-            But it started around 2016 which coincidently is when north south interconnector coming into play. \
-                This probably helped UK grid stabilizes the electricty to overcome the demand spikes of it."
-
-def plot_concurrently(window_size):
-    chart_sequence = ["Total Electricity Demand Over Time", "Average Energy Sources Trend", "Demand vs Production", "Electricity Demand Per Day", "Interconnectors Comparison"]
-    results = {}
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {
-            executor.submit(demand_over_time, window_size): "Total Electricity Demand Over Time",
-            executor.submit(energy_contribution, window_size): "Average Energy Sources Trend",
-            executor.submit(demand_v_production, window_size): "Demand vs Production",
-            executor.submit(demand_during_sleep): "Electricity Demand Per Day",
-            executor.submit(ict_visualization, window_size): "Interconnectors Comparison",
-        }
-
-        for future in concurrent.futures.as_completed(futures):
-            chart_name, fig, description = future.result() 
-            results[chart_name] = (fig, description)
-
-    for chart_name in chart_sequence:
-        if chart_name in results:
-
-            st.header(chart_name)
-            fig, description = results[chart_name]  
-            
+def fetch_data(query, version=None, timer=None):
+    # results are cached across sessions until the next build as immutable Arrow tables
+    timer = timer or ChartTimer(None)
+    with timer.phase('query'):
+        return arrays(fetch_cached(query, version), timer)
+
+def precomputed_chart(chart_name, window_size, version, timer):
+    # the figure the build serialised for this chart and window, parsed once per process and version,
+    # None when the warehouse was built without them
+    with timer.phase('query'):
+        try:
+            table = fetch_cached(figure_cache_query(chart_name, window_size, version), version)
+        except duck.CatalogException:
+            return None
+    if table.num_rows == 0:
+        return None
+    timer.size('figure_bytes', len(table['figure'][0].as_py()))
+    with timer.phase('figure'):
+        fig = figure_cache.get((chart_name, window_size, version),
+                               lambda: pio.from_json(table['figure'][0].as_py(), skip_invalid=True))
+    return chart_name, fig, table['description'][0].as_py()
+
+def load_chart(chart_name, window_size, version, start=None, end=None, resolution='daily', timer=None):
+    # the default view, the whole history at daily resolution, is served from the figures precomputed
+    # by the build, custom ranges and resolutions are computed live
+    if start is None and end is None and resolution == 'daily':
+        chart = precomputed_chart(chart_name, window_size, version, timer)
+        if chart is not None:
+            return chart
+    return CHARTS[chart_name](lambda query, timer: fetch_data(query, version, timer), window_size, start, end, resolution, timer=timer)
+
+def timed(chart_name, timer, *args):
+    # runs in a worker thread, a failing chart is returned as its error instead of raising so the
+    # other charts still render
+    try:
+        return load_chart(chart_name, *args, timer=timer), None
+    except Exception as error:
+        logger.exception(f'{timer.chart} failed')
+        return None, f'{type(error).__name__}: {error}'
+
+def render_chart(slot, chart_name, chart, error, timer):
+    # replaces the placeholder of the chart with the chart itself, or with its error
+    with slot.container():
+        st.header(chart_name)
+        if error is not None:
+            st.error("This chart could not be loaded.")
+            timer.finish(error)
+            render_metrics.record(timer)
+            return
+
+        _, fig, description = chart
+        with timer.phase('render'):
             st.plotly_chart(fig) 
             st.markdown(f"""
             <div style='padding: 10px; border: 1px solid #ccc; border-radius: 5px; background-color: #f9f9f9; margin-bottom: 20px;'>
@@ -130,8 +84,70 @@ def plot_concurrently(window_size):
             </div>
             """, unsafe_allow_html=True)
             st.markdown("<br>", unsafe_allow_html=True) 
-            
-st.sidebar.header("Settings")
-window_size = st.sidebar.slider("Choose desired Moving Average (MA)", min_value=10, max_value=100, value=50, step=10)
+    timer.finish()
+    render_metrics.record(timer)
+
+def plot_concurrently(window_size, version, start=None, end=None, resolution='daily'):
+    chart_sequence = list(CHARTS)
+    timers = {chart_name: ChartTimer(chart_name) for chart_name in chart_sequence}
+
+    # the layout is fixed up front, one placeholder per chart in chart_sequence order, and every chart
+    # is drawn into its own placeholder as soon as it is ready, so the first chart no longer waits for the slowest
+    slots = {}
+    for chart_name in chart_sequence:
+        slots[chart_name] = st.empty()
+        with slots[chart_name].container():
+            st.header(chart_name)
+            st.caption("Loading...")
+
+    # the cheap 24 point chart is submitted first
+    submit_order = sorted(chart_sequence, key=lambda chart_name: chart_name != "Electricity Demand Per Day")
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = {
+            executor.submit(timed, chart_name, timers[chart_name], window_size, version, start, end, resolution): chart_name
+            for chart_name in submit_order
+        }
 
-plot_concurrently(window_size)
\ No newline at end of file
+        for future in concurrent.futures.as_completed(futures):
+            chart_name = futures[future]
+            chart, error = future.result()
+            render_chart(slots[chart_name], chart_name, chart, error, timers[chart_name])
+
+    return [timers[chart_name].as_dict() for chart_name in chart_sequence]
+
+def debug_panel(page):
+    # ?debug=1 in the url, this page's timings next to the p50/p95 of every session since the app started
+    with st.sidebar.expander("Render timings", expanded=True):
+        st.caption("This page (ms)")
+        st.dataframe([{'chart': entry['chart'], 'total': entry['total_ms'], **entry['phases_ms'], **entry['sizes'],
+                       'error': entry['error']} for entry in page], hide_index=True)
+        st.caption("All sessions (ms)")
+        st.dataframe([{'chart': chart, **stats} for chart, stats in render_metrics.snapshot().items()], hide_index=True)
+        st.json({'query_cache': query_cache.stats(), 'pool': pool.stats()}, expanded=False)
+
+def date_bounds(version):
+    bounds = fetch_data(date_bounds_query(), version)
+    return bounds['first_date'][0].astype(object), bounds['last_date'][0].astype(object)
+
+# ?metrics=1 in the url serves the render metrics as json instead of the dashboard
+if 'metrics' in st.query_params:
+    st.json({'charts': render_metrics.snapshot(), 'query_cache': query_cache.stats(), 'pool': pool.stats()})
+    st.stop()
+
+version = warehouse_version()
+first_date, last_date = date_bounds(version)
+
+st.sidebar.header("Settings")
+resolution = st.sidebar.selectbox("Resolution", list(PERIODS), index=1, format_func=str.title)
+window_size = st.sidebar.slider(f"Choose desired Moving Average (MA) in {PERIODS[resolution].lower()}s", min_value=WINDOW_SIZES[0], max_value=WINDOW_SIZES[-1],
+                                value=DEFAULT_WINDOW_SIZE, step=WINDOW_SIZES[1] - WINDOW_SIZES[0])
+date_range = st.sidebar.date_input("Date range", value=(first_date, last_date), min_value=first_date, max_value=last_date)
+
+# the full history, or a range still being picked, leaves the range open so the whole history is served from the rollups
+start, end = date_range if len(date_range) == 2 else (first_date, last_date)
+if (start, end) == (first_date, last_date):
+    start, end = None, None
+
+page = plot_concurrently(window_size, version, start, end, resolution)
+if 'debug' in st.query_params:
+    debug_panel(page)
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import duckdb as duck
+from cachetools import TTLCache
+from create_schema import warehouse, connect_warehouse, get_warehouse_version
+
+CACHE_TTL = 60 * 60
+CACHE_MAX_ENTRIES = 128
+# an hourly query over the whole history is tens of MB, so the result caches are bounded by bytes too
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+POOL_SIZE = int(os.environ.get('GRIDWATCH_POOL_SIZE', 8))
+POOL_TIMEOUT = 30
+
+def file_id(path):
+    # a build renames a new file over the live one, so the inode tells the warehouse was swapped
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+class PoolTimeout(TimeoutError):
+    pass
+
+class ConnectionPool:
+    # cursors of one shared read-only connection, each DuckDB cursor is its own connection to the
+    # same database instance so the file is opened once per process however many charts run at once,
+    # once a build swaps in a new file the next checkout reopens on it while the cursors still out on
+    # the old file finish their query and are closed when released
+
+    def __init__(self, database=warehouse, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.root = None
+        self.opened = None
+        self.generation = 0
+        self.generations = {}
+        self.idle = []
+        self.lock = threading.Lock()
+        # notified whenever a cursor is released or a slot frees up, a waiter then takes the idle cursor
+        # or opens a new one in the free slot
+        self.available = threading.Condition(self.lock)
+        self.created = 0
+        self.checkouts = 0
+        self.replaced = 0
+        self.swaps = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def open_cursor(self):
+        with self.lock:
+            if self.root is None:
+                self.opened = file_id(self.database)
+                self.root = connect_warehouse(self.database, read_only=True)
+            cursor = self.root.cursor()
+            self.generations[id(cursor)] = self.generation
+            return cursor
+
+    def close_cursor(self, cursor):
+        with self.lock:
+            self.generations.pop(id(cursor), None)
+        cursor.close()
+
+    def check_swap(self):
+        # the old root is dropped rather than closed, closing it would close the cursors still out on it,
+        # DuckDB keeps the old file open until the last of them is closed
+        if self.root is None or file_id(self.database) == self.opened:
+            return
+        with self.available:
+            if self.root is None or file_id(self.database) == self.opened:
+                return
+            self.root = None
+            self.generation += 1
+            self.swaps += 1
+            stale, self.idle = self.idle, []
+            self.created -= len(stale)
+            self.available.notify_all()
+        for cursor in stale:
+            self.close_cursor(cursor)
+
+    def healthy(self, cursor):
+        try:
+            cursor.execute('SELECT 1').fetchone()
+            return True
+        except duck.Error:
+            return False
+
+    def acquire(self):
+        start = time.perf_counter()
+        self.check_swap()
+        deadline = start + self.timeout
+        cursor = None
+        with self.available:
+            # an idle cursor, else a new one while the pool is under its size, else wait for a release
+            while not self.idle and self.created >= self.size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise PoolTimeout(f'no warehouse connection released within {self.timeout}s, '
+                                      f'all {self.size} are in use')
+                self.available.wait(remaining)
+            if self.idle:
+                cursor = self.idle.pop()
+            else:
+                self.created += 1
+        if cursor is None:
+            try:
+                cursor = self.open_cursor()
+            except Exception:
+                with self.available:
+                    self.created -= 1
+                    self.available.notify()
+                raise
+        if not self.healthy(cursor):
+            self.close_cursor(cursor)
+            with self.lock:
+                self.replaced += 1
+            cursor = self.open_cursor()
+
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return cursor
+
+    def release(self, cursor):
+        # decided under the lock check_swap takes, so a cursor on the old file never goes back idle after a
+        # swap, a cursor of a closed pool has no generation left and is only closed
+        with self.available:
+            generation = self.generations.get(id(cursor))
+            current = generation is not None and generation == self.generation
+            if current:
+                self.idle.append(cursor)
+            elif generation is not None:
+                self.created -= 1
+            self.available.notify()
+        if not current:
+            self.close_cursor(cursor)
+
+    @contextmanager
+    def cursor(self):
+        cursor = self.acquire()
+        try:
+            yield cursor
+        finally:
+            self.release(cursor)
+
+    def close(self):
+        with self.available:
+            for cursor in self.idle:
+                cursor.close()
+            self.idle = []
+            if self.root is not None:
+                self.root.close()
+            self.root = None
+            self.opened = None
+            self.generations.clear()
+            self.created = 0
+            self.available.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'open': self.created,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'replaced': self.replaced,
+                'swaps': self.swaps,
+                'wait_avg_ms': 1000 * self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max_ms': 1000 * self.wait_max,
+            }
+
+class ResultCache:
+    # query results shared by every session of the app, keyed on the query text and the warehouse
+    # version so a new build invalidates them, TTLCache evicts the least recently used entry when full,
+    # with getsizeof it holds up to max_bytes as that function measures them instead of max_entries
+    # entries and a value larger than the whole budget is returned without being cached
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES, getsizeof=None):
+        if getsizeof is None:
+            self.cache = TTLCache(maxsize=max_entries, ttl=ttl)
+        else:
+            self.cache = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=getsizeof)
+        self.sized = getsizeof is not None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.oversized = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+        # computed outside the lock so a slow query does not hold up the other charts
+        value = compute()
+        with self.lock:
+            try:
+                self.cache[key] = value
+            except ValueError:
+                # cachetools refuses a value larger than maxsize
+                self.oversized += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {'entries': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+            if self.sized:
+                stats.update({'bytes': self.cache.currsize, 'max_bytes': self.cache.maxsize, 'oversized': self.oversized})
+            return stats
+
+query_cache = ResultCache(getsizeof=lambda table: table.nbytes)
+# the figures precomputed by the build once parsed, keyed like the queries on the warehouse version
+figure_cache = ResultCache()
+pool = ConnectionPool()
+
+def warehouse_version():
+    with pool.cursor() as con:
+        return get_warehouse_version(con)
+
+def fetch_cached(query, version):
+    def run():
+        with pool.cursor() as con:
+            return con.execute(query).fetch_arrow_table()
+    return query_cache.get((query, version), run)